@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the interpreter and the code generator.
+
+Every program (the samples plus some bfcg workloads) is run with every
+interpreter mode, each in a fresh process, reporting the wall time of a
+run, the BF instructions executed per second and the peak memory. Every
+bfcg workload is compiled with every strategy, reporting the length of
+the code and the BF instructions it executes.
+
+Usage: bf.bench.py [-o results.json] [-b baseline.json] [-t tolerance]
+
+Results are written as JSON with -o. With -b they are compared against a
+previous results file: timings and memory more than 'tolerance' (default
+0.25) worse, or any increase in generated code length or steps, are
+reported as regressions and the exit status is 1.
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import resource
+import multiprocessing
+
+from cStringIO import StringIO
+
+from bf import Brainfuck, ADD, MOVE
+import bfcg
+
+# Sample programs and their input
+SAMPLES = (
+    ('WTbF', ''),
+    ('divide', ''),
+    ('euclides', '1071\n462\n'),
+    ('print_num', ''),
+    ('read_num', '12345\n'),
+)
+
+TEXT = ' '.join(['The quick brown fox jumps over the lazy dog.'] * 8)
+
+# Generated workloads: name, bfcg source and input
+WORKLOADS = (
+    ('ndup_chain', '1 2 3 4 5 ' + 'NDUP 5 DROP DROP DROP DROP DROP ' * 20, ''),
+    ('print_num_loop', '200 WHILE DUP PRINT_NUM LF DEC ENDWHILE', ''),
+    ('long_string', "'%s' PRINT_STR_AND_CLEAN" % TEXT, ''),
+    ('div_heavy', '250 WHILE DUP 7 DIV ADD DROP DEC ENDWHILE', ''),
+    ('read_and_multiply', 'READ_NUM READ_NUM MUL PRINT_NUM LF', '123\n45\n'),
+    ('stack_shuffle', 'READ_NUM READ_NUM READ_NUM ' + 'ROT ROT SWAP ADD DUP ROT ' * 10 + 'PRINT_NUM', '12\n34\n56\n'),
+)
+
+# Interpreter modes: name, optimize and run() arguments
+MODES = (
+    ('interpreter', True, {}),
+    ('unoptimized', False, {}),
+    ('codegen', True, {'engine': 'codegen'}),
+    ('sparse', True, {'sparse': True}),
+)
+
+# bfcg strategies: name and compile options
+STRATEGIES = [(objective, {'objective': objective}) for objective in bfcg.OBJECTIVES]
+STRATEGIES.append(('size-nofold', {'objective': 'size', 'fold': False}))
+STRATEGIES.append(('size-noplan', {'objective': 'size', 'plan': False}))
+
+MAX_OP = 100000000
+
+# Timing rounds per run, the best one is kept
+ROUNDS = 5
+
+# Memory growth below this (in KB) is never a regression, as ru_maxrss
+# grows by whole pages
+MEMORY_SLACK = 1024
+
+# Metrics checked against the baseline, and whether they only compare
+# within the tolerance (timings) or must not grow at all
+METRICS = {
+    'wall_time': True,
+    'instructions_per_second': True,
+    'peak_memory_kb': True,
+    'length': False,
+    'steps': False,
+}
+
+def steps(code, input):
+    """
+    Number of BF instructions executed by the code, counting a run of '+'
+    or '>' as its length.
+    """
+    bf = Brainfuck(code, input, optimize = False)
+    profile = bf.profile(max_op = MAX_OP)
+    total = 0
+    for op, arg, count in zip(bf.ops, bf.args, profile.counts):
+        if op in (ADD, MOVE):
+            count *= abs(arg)
+        total += count
+    return total
+
+def programs():
+    """
+    List of (name, code, input) of the programs to run.
+    """
+    result = []
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+    for name, input in SAMPLES:
+        f = open(os.path.join(path, name + '.bf'), 'r')
+        code = f.read().replace('#', '')
+        f.close()
+        result.append((name, code, input))
+    for name, source, input in WORKLOADS:
+        result.append((name, bfcg.compile(source), input))
+    return result
+
+def bench_run(task):
+    """
+    Run a program with an interpreter mode, in a process of its own, and
+    return its metrics. The wall time is the best of ROUNDS rounds, each
+    repeating the run for at least 0.05 seconds.
+    """
+    code, input, optimize, kwargs = task
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    bf = Brainfuck(code, input, optimize = optimize)
+
+    # First run, also building the codegen function
+    bf.run(max_op = MAX_OP, **kwargs)
+
+    best = None
+    for i in range(ROUNDS):
+        count = 0
+        start = time.time()
+        while True:
+            bf.input = StringIO(input)
+            bf.run(max_op = MAX_OP, **kwargs)
+            count += 1
+            elapsed = time.time() - start
+            if elapsed >= 0.05:
+                break
+        if best is None or elapsed / count < best:
+            best = elapsed / count
+
+    return {
+        'wall_time': best,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory,
+    }
+
+def bench_interpreter(pool):
+    """
+    Return {program: {mode: metrics}} for every program and mode.
+    """
+    results = {}
+    for name, code, input in programs():
+        instructions = steps(code, input)
+        results[name] = {}
+        for mode, optimize, kwargs in MODES:
+            metrics = pool.apply(bench_run, ((code, input, optimize, kwargs),))
+            metrics['instructions'] = instructions
+            metrics['instructions_per_second'] = instructions / metrics['wall_time']
+            results[name][mode] = metrics
+    return results
+
+def bench_generator():
+    """
+    Return {workload: {strategy: metrics}} for every workload and strategy.
+    """
+    results = {}
+    for name, source, input in WORKLOADS:
+        results[name] = {}
+        for strategy, options in STRATEGIES:
+            code = bfcg.compile(source, options)
+            results[name][strategy] = {
+                'length': len(code),
+                'steps': steps(code, input),
+            }
+    return results
+
+def compare(results, baseline, tolerance, path = ()):
+    """
+    Return the list of regressions of results against baseline, as text.
+    """
+    regressions = []
+    for key, value in sorted(results.items()):
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            regressions += compare(value, baseline[key], tolerance, path + (key,))
+            continue
+        if key not in METRICS:
+            continue
+        old = baseline[key]
+        limit = tolerance if METRICS[key] else 0
+        if key == 'instructions_per_second':
+            worse = value < old * (1 - limit)
+        elif key == 'peak_memory_kb':
+            worse = value > old * (1 + limit) + MEMORY_SLACK
+        else:
+            worse = value > old * (1 + limit)
+        if worse:
+            regressions.append('%s: %g -> %g' % ('/'.join(path + (key,)), old, value))
+    return regressions
+
+def report(results):
+    """
+    Return the results as text tables.
+    """
+    lines = []
+    lines.append('%-20s %-12s %12s %12s %14s %10s' % ('program', 'mode', 'instructions',
+        'wall time', 'instr/second', 'memory KB'))
+    for name, modes in sorted(results['interpreter'].items()):
+        for mode, metrics in sorted(modes.items()):
+            lines.append('%-20s %-12s %12i %12.6f %14i %10i' % (name, mode, metrics['instructions'],
+                metrics['wall_time'], metrics['instructions_per_second'], metrics['peak_memory_kb']))
+    lines.append('')
+    lines.append('%-20s %-12s %12s %12s' % ('workload', 'strategy', 'length', 'steps'))
+    for name, strategies in sorted(results['generator'].items()):
+        for strategy, metrics in sorted(strategies.items()):
+            lines.append('%-20s %-12s %12i %12i' % (name, strategy, metrics['length'], metrics['steps']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    '''
+    Main entry point
+    '''
+
+    output = None
+    baseline = None
+    tolerance = 0.25
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:b:t:", ["help", "output=", "baseline=", "tolerance="])
+    except getopt.GetoptError:
+        print "Wrong parameters."
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print __doc__
+            sys.exit()
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt in ('-b', '--baseline'):
+            if not os.path.exists(arg):
+                print "File '%s' does not exist" % arg
+                sys.exit(2)
+            f = open(arg, 'r')
+            baseline = json.load(f)
+            f.close()
+        elif opt in ('-t', '--tolerance'):
+            tolerance = float(arg)
+
+    pool = multiprocessing.Pool(1, maxtasksperchild = 1)
+    results = {
+        'interpreter': bench_interpreter(pool),
+        'generator': bench_generator(),
+    }
+    pool.close()
+    pool.join()
+
+    print report(results)
+
+    if output:
+        f = open(output, 'w')
+        json.dump(results, f, indent = 2, sort_keys = True)
+        f.close()
+
+    if baseline:
+        regressions = compare(results, baseline, tolerance)
+        print
+        if regressions:
+            print "Regressions against the baseline:"
+            for line in regressions:
+                print "  " + line
+            sys.exit(1)
+        print "No regressions against the baseline."
@@ -12,15 +12,699 @@ opcode, prints the current position in the code and the contents of the memory.
 """
 
 import os
+import re
 import sys
+import stat
+import mmap
 import cStringIO
 import time
+import marshal
+import json
+import struct
+import bisect
+import hashlib
+import inspect
+import linecache
+import textwrap
+import tempfile
+from collections import deque
+from array import array
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Intermediate representation opcodes. The source is compiled into a list of
+# (opcode, argument) tuples, where runs of '+'/'-' and '>'/'<' are folded into
+# a single ADD or MOVE and brackets carry the index of their matching bracket.
+# The optimizer replaces common loop idioms with CLEAR ('[-]'), MUL (transfer
+# and multiply loops like '[->+>++<<]') and SCAN ('[>]', '[<<]'). The program
+# is then kept as parallel arrays of opcodes and arguments (see
+# Brainfuck._pack()).
+ADD, MOVE, JZ, JNZ, OUT, IN, DEBUG, CLEAR, MUL, SCAN = range(10)
+
+# Bump whenever the compiled program format changes, so cached programs from
+# older versions are not used.
+CACHE_VERSION = 5
+
+# Every byte that is not a Brainfuck operator, deleted from the source with
+# str.translate()
+IGNORED = ''.join([chr(i) for i in range(256) if chr(i) not in '+-><[].,#'])
+
+# Bytes of a source file filtered at once by load_source()
+SOURCE_BLOCK = 1 << 20
+
+BRACKETS = re.compile(r'[\[\]]')
 
 class BrainfuckError(Exception):          
     def __init__(self, message, errnr):   
         self.errnr = errnr                
         Exception.__init__(self, message) 
 
+    def __reduce__(self):
+        # Keep the error number when crossing process boundaries
+        return (BrainfuckError, (self.args[0], self.errnr))
+
+# Tape storage for each supported cell width. None means unbounded Python ints
+# that never wrap; the others wrap at 2**bits.
+CELL_TYPES = {
+    8: 'B',
+    16: 'H',
+    32: 'I' if array('I').itemsize == 4 else 'L',
+}
+
+# Cells allocated when a dense tape is created. It then grows on demand.
+TAPE_CHUNK = 1024
+
+# NumPy types of the batch tapes (see Brainfuck.run_batch()). Unbounded
+# cells are 64 bit there.
+BATCH_TYPES = {
+    None: 'int64',
+    8: 'uint8',
+    16: 'uint16',
+    32: 'uint32',
+}
+
+class SparseTape(dict):
+    """
+    Tape holding only the cells that have been written to. Any other cell
+    reads as zero.
+    """
+
+    def __missing__(self, key):
+        return 0
+
+def tape(mem_size, cell_bits = None, sparse = False):
+    """
+    Allocate a zeroed tape of mem_size cells of cell_bits bits and return it
+    with the mask to apply on every write (-1, a no-op, for unbounded cells).
+    8 bit cells use a bytearray and 16 and 32 bit cells an array. A sparse
+    tape is a SparseTape whatever the cell width.
+    """
+    if cell_bits is None:
+        mask = -1
+    elif cell_bits in CELL_TYPES:
+        mask = (1 << cell_bits) - 1
+    else:
+        raise BrainfuckError('Unsupported cell width %s' % cell_bits, 3)
+    if sparse:
+        return SparseTape(), mask
+    if cell_bits is None:
+        return [0] * mem_size, mask
+    if cell_bits == 8:
+        return bytearray(mem_size), mask
+    return array(CELL_TYPES[cell_bits], [0]) * mem_size, mask
+
+def scanner(mem):
+    """
+    Return a function scan(dp, step) that moves dp by step until it finds a
+    zero cell, as the loops '[>]' or '[<<]' do. Single steps on a bytearray
+    tape are a search over the buffer and forward single steps on a list use
+    list.index. Cells past the end of a dense tape count as zero, so a
+    forward scan may stop there; a backward scan past the start returns a
+    negative position.
+    """
+    if isinstance(mem, bytearray):
+        find = mem.find
+        rfind = mem.rfind
+        def scan(dp, step):
+            if step == 1:
+                dp = find('\x00', dp)
+                return len(mem) if dp < 0 else dp
+            if step == -1:
+                return rfind('\x00', 0, dp + 1)
+            return scan_loop(mem, dp, step)
+    elif isinstance(mem, list):
+        index = mem.index
+        def scan(dp, step):
+            if step == 1:
+                try:
+                    return index(0, dp)
+                except ValueError:
+                    return len(mem)
+            return scan_loop(mem, dp, step)
+    else:
+        def scan(dp, step):
+            return scan_loop(mem, dp, step)
+    return scan
+
+def scan_loop(mem, dp, step):
+    """
+    Scan for a zero cell one step at a time (see scanner()).
+    """
+    if step < 0:
+        while dp >= 0 and mem[dp]:
+            dp += step
+        return dp
+    try:
+        while mem[dp]:
+            dp += step
+    except IndexError:
+        pass
+    return dp
+
+# Bytes read at once from the input
+INPUT_BLOCK = 65536
+
+class InputBuffer(object):
+    """
+    Buffered input for the ',' instruction. Regular files are mapped into
+    memory, other files (pipes, terminals) are read with os.read() and any
+    other file-like object with read(), INPUT_BLOCK bytes at a time.
+
+    read() returns the value of the next byte of the current block. It is
+    the next() of an iterator over the block, so it costs a single C call,
+    and raises StopIteration at the end of the block. fill() then loads the
+    next block and replaces read(), or returns False at the end of the input.
+    sync() gives the bytes of the block not read yet back to the input, so
+    its position is right after the last byte read. Input that cannot be
+    moved back (pipes, sockets) keeps them in the block instead.
+    """
+
+    def __init__(self, input, block = INPUT_BLOCK):
+        self.input = input
+        self.block = block
+        self.read = iter(()).next
+        self.done = False
+        self.map = None
+        self.fd = None
+        try:
+            fd = input.fileno()
+        except (AttributeError, IOError, ValueError):
+            return
+        try:
+            info = os.fstat(fd)
+            if stat.S_ISREG(info.st_mode) and info.st_size > input.tell():
+                self.map = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+                self.offset = input.tell()
+            else:
+                self.fd = fd
+        except (IOError, OSError, mmap.error):
+            self.fd = fd
+
+    def fill(self):
+        """
+        Read the next block and return False if there was nothing left.
+        """
+        if self.done:
+            return False
+        try:
+            if self.map is not None:
+                data = self.map[self.offset:self.offset + self.block]
+                self.offset += len(data)
+            elif self.fd is not None:
+                data = os.read(self.fd, self.block)
+            else:
+                data = self.input.read(self.block)
+        except (IOError, OSError, ValueError):
+            data = ''
+        if not data:
+            self.done = True
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                self._seek(self.offset)
+            return False
+        self.read = iter(bytearray(data)).next
+        return True
+
+    def sync(self):
+        """
+        Move the input back to the first byte not read yet and drop the rest
+        of the block. If the input cannot be moved, the block is kept, so no
+        byte is lost to the next read().
+        """
+        remaining = self.read.__self__.__length_hint__()
+        if not remaining:
+            return
+        if self.map is not None:
+            self.offset -= remaining
+            self._seek(self.offset)
+        elif self.fd is not None:
+            try:
+                os.lseek(self.fd, -remaining, os.SEEK_CUR)
+            except OSError:
+                return
+        else:
+            try:
+                self.input.seek(self.input.tell() - remaining)
+            except (AttributeError, IOError, ValueError):
+                return
+        self.read = iter(()).next
+
+    def _seek(self, offset):
+        try:
+            self.input.seek(offset)
+        except (AttributeError, IOError, ValueError):
+            pass
+
+def load_source(path, block = SOURCE_BLOCK):
+    """
+    Return the Brainfuck operators of a source file. The file is mapped
+    into memory and filtered block by block, so only the operators are ever
+    held in memory, not the comments around them.
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        return ''.join([data[i:i + block].translate(None, IGNORED) for i in range(0, len(data), block)])
+    finally:
+        data.close()
+
+class BrainfuckState(object):
+    """
+    Execution state of a program: tape, pointers and instruction counter.
+    Brainfuck.start() creates one and Brainfuck.resume() runs it for a number
+    of instructions at a time. It can be saved with dumps() and restored with
+    BrainfuckState.loads(); the input and output file handles are not part
+    of the state.
+
+    The tape starts with TAPE_CHUNK cells (or mem_size if smaller) and
+    grows on demand up to mem_size cells, or without limit if mem_size is
+    None. A sparse tape only stores the cells written to.
+    """
+
+    def __init__(self, mem_size = 30000, cell_bits = None, max_op = 1000000, sparse = False):
+        limit = sys.maxint if mem_size is None else mem_size
+        self.mem, self.mask = tape(min(limit, TAPE_CHUNK), cell_bits, sparse)
+        self.mem_size = mem_size
+        self.limit = limit      # Maximum number of cells
+        self.size = limit if sparse else len(self.mem)  # Cells available
+        self.cell_bits = cell_bits
+        self.sparse = sparse
+        self.max_op = max_op
+        self.ip = 0             # Instruction pointer
+        self.dp = 0             # Data pointer
+        self.m_dp = 0           # Maximum data pointer
+        self.ic = 0             # Instruction counter
+        self.done = False
+
+    def grow(self, dp):
+        """
+        Make the tape large enough to hold cell dp, at least doubling it, and
+        return its new size. Raises a BrainfuckError past the limit.
+        """
+        if dp >= self.limit:
+            raise BrainfuckError('Data pointer overflow at position %i' % dp, 5)
+        size = min(max(self.size * 2, (dp // TAPE_CHUNK + 1) * TAPE_CHUNK), self.limit)
+        self.mem.extend(tape(size - self.size, self.cell_bits)[0])
+        self.size = size
+        return size
+
+    def dumps(self):
+        """
+        Serialize the state to a string.
+        """
+        mem = self.mem
+        if isinstance(mem, SparseTape):
+            data = dict(mem)
+        elif isinstance(mem, list):
+            data = mem
+        elif isinstance(mem, bytearray):
+            data = str(mem)
+        else:
+            data = mem.tostring()
+        return marshal.dumps((1, self.ip, self.dp, self.m_dp, self.ic,
+            self.max_op, self.mem_size, self.cell_bits, self.sparse, self.done, data))
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Restore a state serialized with dumps().
+        """
+        try:
+            version, ip, dp, m_dp, ic, max_op, mem_size, cell_bits, sparse, done, data = marshal.loads(data)
+        except (ValueError, EOFError, TypeError):
+            raise BrainfuckError('Invalid state', 3)
+        state = cls(mem_size, cell_bits, max_op, sparse)
+        if sparse:
+            state.mem.update(data)
+        elif cell_bits is None:
+            state.mem = data
+        elif cell_bits == 8:
+            state.mem = bytearray(data)
+        else:
+            state.mem = array(CELL_TYPES[cell_bits], data)
+        if not sparse:
+            state.size = len(state.mem)
+        state.ip, state.dp, state.m_dp, state.ic, state.done = ip, dp, m_dp, ic, done
+        return state
+
+class BrainfuckBatch(object):
+    """
+    State of the runs of a program on many inputs at once, used by
+    Brainfuck.run_batch(). The tape is a 2-D NumPy array with a row per
+    input, grown by columns on demand up to mem_size (without limit if
+    None, as in BrainfuckState), and every register
+    (ip, dp, ic and the input position) is an array with a value per row.
+    Unbounded cells are 64 bit integers here.
+    """
+
+    def __init__(self, inputs, mem_size = 30000, max_op = 1000000, cell_bits = None):
+        if numpy is None:
+            raise BrainfuckError('Batch runs need NumPy', 3)
+        if cell_bits not in BATCH_TYPES:
+            raise BrainfuckError('Unsupported cell size: %r' % (cell_bits,), 3)
+        count = len(inputs)
+        limit = sys.maxint if mem_size is None else mem_size
+        self.count = count
+        self.mem_size = mem_size
+        self.limit = limit      # Maximum number of cells
+        self.max_op = max_op
+        self.mask = -1 if cell_bits is None else (1 << cell_bits) - 1
+        self.mem = numpy.zeros((count, min(limit, TAPE_CHUNK)), BATCH_TYPES[cell_bits])
+        self.ip = numpy.zeros(count, numpy.int64)
+        self.dp = numpy.zeros(count, numpy.int64)
+        self.ic = numpy.zeros(count, numpy.int64)
+        self.active = numpy.ones(count, bool)
+        self.changed = False
+        self.errors = {}
+
+        # Inputs padded into a single array, read at pos up to lengths
+        self.lengths = numpy.array([len(input) for input in inputs], numpy.int64)
+        self.data = numpy.zeros((count, max([len(input) for input in inputs] + [0]) + 1), numpy.uint8)
+        for row, input in enumerate(inputs):
+            if input:
+                self.data[row, :len(input)] = numpy.frombuffer(input, numpy.uint8)
+        self.pos = numpy.zeros(count, numpy.int64)
+
+        # Rows and values of every OUT, in order
+        self.out_rows = []
+        self.out_values = []
+
+    def rows(self):
+        """
+        Return the indices of the rows still running.
+        """
+        self.changed = False
+        return numpy.flatnonzero(self.active)
+
+    def finish(self, rows):
+        """
+        Take the rows out of the batch.
+        """
+        self.active[rows] = False
+        self.changed = True
+
+    def fail(self, rows, message, errnr):
+        """
+        Take the rows out of the batch with an error.
+        """
+        for row in rows:
+            self.errors[row] = BrainfuckError(message, errnr)
+        self.finish(rows)
+
+    def bounds(self, rows, cells):
+        """
+        Fail the rows whose cell is off the tape and grow the tape for the
+        others. Returns a boolean array telling which rows are left.
+        """
+        under = cells < 0
+        over = cells >= self.limit
+        if under.any():
+            self.fail(rows[under], 'Data pointer underflow', 5)
+        if over.any():
+            for row, cell in zip(rows[over], cells[over]):
+                self.fail([row], 'Data pointer overflow at position %i' % cell, 5)
+        ok = ~(under | over)
+        if ok.any() and cells[ok].max() >= self.mem.shape[1]:
+            self.grow(cells[ok].max())
+        return ok
+
+    def grow(self, cell):
+        """
+        Make the tape wide enough to hold cell, at least doubling it.
+        """
+        size = self.mem.shape[1]
+        size = min(max(size * 2, (cell // TAPE_CHUNK + 1) * TAPE_CHUNK), self.limit)
+        mem = numpy.zeros((self.count, size), self.mem.dtype)
+        mem[:, :self.mem.shape[1]] = self.mem
+        self.mem = mem
+
+    def results(self):
+        """
+        Return the output of every row, or its BrainfuckError.
+        """
+        outputs = [''] * self.count
+        if self.out_rows:
+            rows = numpy.concatenate(self.out_rows)
+            values = numpy.concatenate(self.out_values)
+            values = values[numpy.argsort(rows, kind = 'mergesort')]
+            ends = numpy.cumsum(numpy.bincount(rows, minlength = self.count))
+            start = 0
+            for row in range(self.count):
+                outputs[row] = values[start:ends[row]].tostring()
+                start = ends[row]
+        return [self.errors.get(row, outputs[row]) for row in range(self.count)]
+
+class BrainfuckProfile(object):
+    """
+    Execution profile of a program, as returned by Brainfuck.profile().
+
+    counts holds the number of executions of each compiled instruction,
+    instructions the total and extent the number of tape cells touched.
+    loops has one entry per loop of the source, keyed by the position of
+    its '[' in the filtered code (as in Brainfuck.jumps), sorted by the
+    number of instructions executed inside it, nested loops included.
+    Loops run as a single instruction by the optimizer have the idiom as
+    kind and no iteration count.
+    """
+
+    kinds = {JZ: 'loop', CLEAR: 'clear', MUL: 'mul', SCAN: 'scan'}
+
+    def __init__(self, bf, counts, instructions, extent, output = None):
+        self.counts = counts
+        self.instructions = instructions
+        self.extent = extent
+        self.output = output
+
+        # Running sum of counts to add up the instructions inside each loop
+        totals = [0]
+        for count in counts:
+            totals.append(totals[-1] + count)
+
+        loops = []
+        jumps = bf.jumps
+        for ip, (op, arg) in enumerate(zip(bf.ops, bf.args)):
+            if op not in self.kinds:
+                continue
+            position = bf.positions[ip]
+            end = jumps[position]
+            loop = {
+                'position': position,
+                'end': end,
+                'kind': self.kinds[op],
+                'entries': counts[ip],
+                'iterations': None,
+                'instructions': counts[ip],
+                'code': bf.code[position:end + 1],
+            }
+            if op == JZ:
+                loop['iterations'] = counts[arg]
+                loop['instructions'] = totals[arg + 1] - totals[ip]
+            loops.append(loop)
+        loops.sort(key = lambda loop: (-loop['instructions'], loop['position']))
+        self.loops = loops
+
+    def report(self, top = 20, width = 40):
+        """
+        Return the hot loop report as text, with the top loops only and their
+        code cut at width characters.
+        """
+        lines = []
+        lines.append('Instructions: %i   Tape extent: %i cells' % (self.instructions, self.extent))
+        lines.append('')
+        lines.append('%8s %12s %6s %10s %12s  %-5s  %s' % ('position', 'instructions', '%',
+            'entries', 'iterations', 'kind', 'code'))
+        for loop in self.loops[:top]:
+            code = loop['code']
+            if len(code) > width:
+                code = code[:width - 3] + '...'
+            iterations = loop['iterations']
+            lines.append('%8i %12i %6.2f %10i %12s  %-5s  %s' % (loop['position'],
+                loop['instructions'], 100.0 * loop['instructions'] / max(self.instructions, 1),
+                loop['entries'], '-' if iterations is None else iterations, loop['kind'], code))
+        return '\n'.join(lines)
+
+    def json(self, top = None):
+        """
+        Return the profile as a JSON string, with the top loops only if given.
+        """
+        return json.dumps({
+            'instructions': self.instructions,
+            'extent': self.extent,
+            'loops': self.loops[:top],
+        })
+
+class Hook(object):
+    """
+    Base tracing hook. Hooks passed to Brainfuck.run() or resume() make the
+    program run in the traced interpreter, which calls step() after every
+    'every' instructions (never if 0) and whenever execution reaches one of
+    the source positions in 'breakpoints', and debug() on every '#', after
+    the tape has been dumped as in an untraced run. Both get
+    the Brainfuck instance, the index of the next compiled instruction, the
+    data pointer, the instruction counter, the tape and the maximum data
+    pointer. If step() returns True the run pauses there, as at the end of a
+    resume() slice.
+    """
+
+    every = 0
+    breakpoints = ()
+
+    def step(self, bf, ip, dp, ic, mem, m_dp):
+        pass
+
+    def debug(self, bf, ip, dp, ic, mem, m_dp):
+        pass
+
+class DebugHook(Hook):
+    """
+    Print the source and the tape after every instruction (run(debug=True)).
+    """
+
+    every = 1
+
+    def step(self, bf, ip, dp, ic, mem, m_dp):
+        code = bf.code
+        code_len = bf.code_len
+        pos = bf.positions[ip] if ip < len(bf.positions) else code_len
+        sys.stdout.write(code + '    ')
+        for i in range(m_dp + 1):
+            sys.stdout.write("%03i " % (mem[i]) )
+        sys.stdout.write("{%i} " % ic )
+        sys.stdout.write('\n')
+        print ' ' * pos + '^' + ' ' * (code_len - pos) + '   ' + '    ' * dp + '^^^'
+        sys.stdout.write('\n')
+
+class PrefixHook(Hook):
+    """
+    Pause at every breakpoint, used by Brainfuck.prepare() to stop before
+    the first input.
+    """
+
+    def step(self, bf, ip, dp, ic, mem, m_dp):
+        return True
+
+# Trace record: instruction counter, source position, data pointer and value
+# of the current cell.
+TRACE_RECORD = struct.Struct('<qiiq')
+
+class TraceRecorder(Hook):
+    """
+    Record a compact binary trace every 'every' instructions. Records are
+    written to file if given, otherwise the last 'size' ones are kept in a
+    ring buffer, returned by data(). Use read_trace() or render_trace() to
+    look at them.
+    """
+
+    def __init__(self, file = None, size = 65536, every = 1, breakpoints = ()):
+        self.file = file
+        self.ring = deque(maxlen = size)
+        self.every = every
+        self.breakpoints = breakpoints
+
+    def step(self, bf, ip, dp, ic, mem, m_dp):
+        pos = bf.positions[ip] if ip < len(bf.positions) else bf.code_len
+        value = mem[dp]
+        if not -(1 << 63) <= value < (1 << 63):
+            value = -1
+        record = TRACE_RECORD.pack(ic, pos, dp, value)
+        if self.file:
+            self.file.write(record)
+        else:
+            self.ring.append(record)
+
+    def data(self):
+        return ''.join(self.ring)
+
+def read_trace(data):
+    """
+    Generator decoding a binary trace into (ic, position, dp, value) tuples.
+    """
+    size = TRACE_RECORD.size
+    for offset in range(0, len(data) - size + 1, size):
+        yield TRACE_RECORD.unpack_from(data, offset)
+
+def render_trace(data, code, context = 10):
+    """
+    Generator rendering a binary trace as text lines, showing the filtered
+    source around the position of each record.
+    """
+    for ic, pos, dp, value in read_trace(data):
+        start = max(pos - context, 0)
+        yield '%10i %6i %6i %6i  %s|%s' % (ic, pos, dp, value,
+            code[start:pos].rjust(context), code[pos:pos + context])
+
+# Extra code of the interpreter loops built by engine() from
+# Brainfuck._interpret(). Breakpoints are turned into instruction indexes; a
+# source position inside a folded run breaks at the instruction that
+# includes it.
+TRACE_SETUP = """
+breaks = {}
+for hook in hooks:
+    for pos in hook.breakpoints:
+        index = bisect.bisect_right(self.positions, pos) - 1
+        breaks.setdefault(max(index, 0), []).append(hook)
+stepping = [hook for hook in hooks if hook.every]
+next_step = min([ic - ic % hook.every + hook.every for hook in stepping] or [sys.maxint])
+"""
+
+TRACE_DEBUG = """
+for hook in hooks:
+    hook.debug(self, ip, dp, ic, mem, m_dp)
+"""
+
+TRACE_AFTER = """
+if ic >= next_step or ip in breaks:
+    pause = False
+    for hook in hooks:
+        if (hook.every and ic % hook.every == 0) or hook in breaks.get(ip, ()):
+            if hook.step(self, ip, dp, ic, mem, m_dp):
+                pause = True
+    next_step = min([ic - ic % hook.every + hook.every for hook in stepping] or [sys.maxint])
+    if pause:
+        break
+"""
+
+def engine(base, name, args, doc, setup = '', before = '', debug = '', after = ''):
+    """
+    Build a variant of the interpreter loop base (Brainfuck._interpret())
+    from its source, with the given name, arguments, docstring and extra
+    code: setup runs before the loop, before once an instruction is
+    fetched, debug after the tape is dumped on '#' and after once the
+    instruction has run. The source is registered with linecache so
+    tracebacks show it.
+    """
+    anchors = {'arg = args[ip]': before, 'self._dump(mem, dp, m_dp)': debug, 'ic += 1': after}
+    lines = ['def %s(%s):' % (name, args)]
+    for line in textwrap.dedent(inspect.getsource(base)).splitlines()[1:]:
+        indent = line[:len(line) - len(line.lstrip())]
+        if line.strip() == 'while ip < program_len:':
+            lines.extend([indent + code for code in setup.strip().splitlines()])
+        lines.append(line)
+        if anchors.get(line.strip()):
+            lines.extend([indent + code for code in anchors[line.strip()].strip().splitlines()])
+    source = '\n'.join(lines) + '\n'
+    filename = '<%s>' % name
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    namespace = {}
+    exec compile(source, filename, 'exec') in globals(), namespace
+    function = namespace[name]
+    function.__doc__ = doc
+    return function
+
 class Brainfuck(object):                                  
     """                                                   
     Brainfuck interpreter.                                
@@ -41,17 +725,23 @@ class Brainfuck(object):
                                                           
     operators = ['+', '-', '>', '<', '[', ']', '.', ',', '#']
  
-    def __init__(self, code, input = sys.stdin, output = None):
+    def __init__(self, code, input = sys.stdin, output = None, optimize = True, cache_dir = None, eof = -1):
         """
         Interpret and run Brainfuck code given in 'code'. Brainfuck program
         will read from input which can be either an open filehandle (default
-        stdin) or a string. Will write to output. If output is None (default),
-        the run() function will return the output instead.
+        stdin) or a string, buffered by an InputBuffer. At the end of the
+        input ',' stores eof: 0, -1 (default, 255 with 8 bit cells) or None
+        to leave the cell unchanged. Will write to output. If output is None
+        (default), the run() function will return the output instead. If
+        optimize is True (default), clear, multiply and scan loops are run as
+        a single instruction each. If cache_dir is given, the parsed and
+        compiled program is stored there, keyed by a hash of the code and the
+        settings, and loaded from there the next time the same code is used.
         """
-        if type(input) == type(''):
-            self.input = cStringIO.StringIO(input)
-        else:
-            self.input = input
+        if eof not in (0, -1, None):
+            raise BrainfuckError('EOF value must be 0, -1 or None', 3)
+        self.eof = eof
+        self.input = input
 
         if output == None:
             self.return_output = True
@@ -60,112 +750,924 @@ class Brainfuck(object):
             self.return_output = False
             self.output = output
 
+        # Python function for the codegen engine, built on first use
+        self._function = None
+
+        # Program as lists for the interpreter loops, built on first use
+        self._lists = None
+
+        # State before the first input, see prepare()
+        self.snapshot = None
+
+        # Remove non-brainfuck operators so the interpreter doesn't have to
+        # process them.
+        if isinstance(code, unicode):
+            code = code.encode('ascii', 'ignore')
+        code = code.translate(None, IGNORED)
+
+        cache = None
+        if cache_dir:
+            key = hashlib.sha1('%i:%i:' % (CACHE_VERSION, bool(optimize)))
+            key.update(code)
+            cache = os.path.join(cache_dir, key.hexdigest() + '.bfc')
+            if self._load(cache):
+                self._cache = cache
+                return
+        self._cache = cache
+
         # First simple syntax checking
         if code.count('[') != code.count(']'):
             raise BrainfuckError('Unmatched number of brackets', 1)
- 
-        # Remove non-brainfuck operators so the interpreter doesn't have to
-        # process them.
-        code = ''.join([op for op in code if op in self.operators])
 
-        # Find matching brackets
-        jumps = {}
-        code_len = len(code)
+        # Check that every bracket has its match
         stack = []
-        for ip in range(0, code_len):
+        for match in BRACKETS.finditer(code):
+            ip = match.start()
             if code[ip] == '[':
                 stack.append(ip)
-            elif code[ip] == ']':
-                if len(stack) == 0:
-                    raise BrainfuckError('Unmatched bracket at position %i' % ip, 4)
-                sip = stack.pop()
-                jumps[sip] = ip
-                jumps[ip] = sip
+            elif len(stack) == 0:
+                raise BrainfuckError('Unmatched bracket at position %i' % ip, 4)
+            else:
+                stack.pop()
         if len(stack):
             raise BrainfuckError('Unmatched bracket at position %i' % stack.pop(), 4)
 
         # Copy references
         self.code = code
-        self.code_len = code_len
-        self.jumps = jumps
+        self.code_len = len(code)
+        self._jumps = None
+
+        # Compile to the intermediate representation
+        program, positions = self._compile(code)
+        if optimize:
+            program, positions = self._optimize(program, positions)
+        self._pack(program, positions)
+
+        if cache:
+            self._save(cache)
+
+    def _get_input(self):
+        return self._input
+
+    def _set_input(self, input):
+        if type(input) == type(''):
+            input = cStringIO.StringIO(input)
+        self._input = input
+        self._reader = InputBuffer(input)
+
+    # Setting the input also replaces the buffer reading from it
+    input = property(_get_input, _set_input)
+
+    def _get_jumps(self):
+        """
+        Array with the position of the matching bracket for every '[' and
+        ']' of the code (and 0 elsewhere), built on first use. Only the
+        profiler needs it.
+        """
+        if self._jumps is None:
+            jumps = array('i', [0]) * self.code_len
+            stack = []
+            for match in BRACKETS.finditer(self.code):
+                ip = match.start()
+                if self.code[ip] == '[':
+                    stack.append(ip)
+                else:
+                    sip = stack.pop()
+                    jumps[sip] = ip
+                    jumps[ip] = sip
+            self._jumps = jumps
+        return self._jumps
+
+    jumps = property(_get_jumps)
+
+    def _get_lists(self):
+        """
+        Return the opcodes and arguments as lists, which the interpreter
+        loops index faster than the arrays. Built on first use.
+        """
+        if self._lists is None:
+            self._lists = (self.ops.tolist(), self.args.tolist())
+        return self._lists
+
+    def _pack(self, program, positions):
+        """
+        Store a list of (opcode, argument) tuples as parallel arrays: ops with
+        the opcodes, args with the arguments (0 for none) and positions with
+        the source positions. The argument of a MUL is the index of its
+        (offset, factor) pairs in the factors list. Arguments and positions
+        are 32 bit, enough for any source under 2 GB.
+        """
+        factors = []
+        args = array('i')
+        for op, arg in program:
+            if op == MUL:
+                factors.append(arg)
+                arg = len(factors) - 1
+            args.append(arg or 0)
+        self.ops = array('B', [op for op, arg in program])
+        self.args = args
+        self.factors = factors
+        self.positions = array('i', positions)
+
+    def _load(self, path):
+        """
+        Load the parsed program from a cache file. Returns False if there is
+        no usable file.
+        """
+        try:
+            f = open(path, 'rb')
+            try:
+                code, ops, args, factors, positions, snapshot = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+        self.code = code
+        self.code_len = len(code)
+        self._jumps = None
+        self.ops = array('B', ops)
+        self.args = array('i', args)
+        self.factors = factors
+        self.positions = array('i', positions)
+        self.snapshot = snapshot
+        return True
+
+    def _save(self, path):
+        """
+        Store the parsed program in a cache file. The file is written under a
+        temporary name and renamed, so concurrent readers never see half of
+        it. Errors are ignored, the cache is only an optimization.
+        """
+        try:
+            fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump((self.code, self.ops.tostring(), self.args.tostring(), self.factors,
+                    self.positions.tostring(), self.snapshot), f)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def __getstate__(self):
+        """
+        Pickle the parsed program only, without file handles or the codegen
+        function, so it can be shipped to worker processes.
+        """
+        state = self.__dict__.copy()
+        for key in ('_input', '_reader', 'output', '_function', '_lists'):
+            del state[key]
+        state['_jumps'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.input = cStringIO.StringIO('')
+        self.output = cStringIO.StringIO()
+        self.return_output = True
+        self._function = None
+        self._lists = None
+
+    def _with_input(self, input):
+        """
+        Return a copy of this instance sharing the parsed program (and the
+        codegen function, if already built) that reads from the given string
+        and returns its output.
+        """
+        clone = object.__new__(Brainfuck)
+        clone.__dict__.update(self.__dict__)
+        clone.input = cStringIO.StringIO(input)
+        clone.output = cStringIO.StringIO()
+        clone.return_output = True
+        return clone
+
+    def run_many(self, inputs, processes = None, **kwargs):
+        """
+        Run the program once for each string in inputs and return the list of
+        outputs, in the same order. Any other keyword argument is passed to
+        run(). The program is parsed only once, here, and the inputs are
+        spread across a multiprocessing pool of the given number of processes
+        (default one per CPU). With processes=1, a single input or no
+        multiprocessing support, everything runs in this process.
+        """
+        inputs = list(inputs)
+        if kwargs.get('engine') == 'codegen' and self._function is None:
+            self._function = self._build_function()
+
+        if processes is None and multiprocessing:
+            processes = multiprocessing.cpu_count()
+        if not multiprocessing or processes <= 1 or len(inputs) <= 1:
+            return [self._with_input(input).run(**kwargs) for input in inputs]
+
+        pool = multiprocessing.Pool(processes, _pool_init, (self, kwargs))
+        try:
+            return pool.map(_pool_run, inputs)
+        finally:
+            pool.terminate()
+
+    def prepare(self, mem_size = 30000, max_op = 1000000, cell_bits = None, sparse = False):
+        """
+        Run the program up to its first ',' (or '#') and keep the state and
+        the output so far in self.snapshot. Later runs with the interpreter
+        and the same mem_size, cell_bits and sparse settings start from
+        there, and a program that never reads its input just returns the
+        output. The snapshot only holds marshal-able values; with a
+        cache_dir it is stored in the cache file with the program.
+        """
+        state = BrainfuckState(mem_size, cell_bits, max_op, sparse)
+        output = ''
+        if self.ops and self.ops[0] not in (IN, DEBUG):
+            hook = PrefixHook()
+            hook.breakpoints = [self.positions[ip] for ip, op in enumerate(self.ops) if op in (IN, DEBUG)]
+            output = ''.join(self._trace(state, [hook], sys.maxint))
+        self.snapshot = (mem_size, cell_bits, sparse, state.dumps(), output)
+        if self._cache:
+            self._save(self._cache)
+
+    def run_batch(self, inputs, mem_size = 30000, max_op = 1000000, cell_bits = None):
+        """
+        Run the program once for each string in inputs, all in lockstep on a
+        BrainfuckBatch, and return the list of outputs in the same order. A
+        row that fails gets its BrainfuckError instead of an output. Each
+        step runs the instruction with the lowest instruction pointer for all
+        the rows that are there, so rows that take a different branch wait
+        for the others to catch up. Rows leave the batch when they finish.
+        There is no single tape to show, so '#' does nothing here. Needs
+        NumPy.
+        """
+        batch = BrainfuckBatch(list(inputs), mem_size, max_op, cell_bits)
+        ops = self.ops
+        args = self.args
+        program_len = len(ops)
+        eof = self.eof
+        mask = batch.mask
+        ip = batch.ip
+        dp = batch.dp
+        ic = batch.ic
+        rows = batch.rows() if program_len else ()
+
+        while len(rows):
+            mem = batch.mem
+            ips = ip[rows]
+            cur = ips.min()
+            sel = rows if ips.max() == cur else rows[ips == cur]
+
+            over = ic[sel] > max_op
+            if over.any():
+                batch.fail(sel[over], 'Maximum number of instructions exceeded', 2)
+                sel = sel[~over]
+            ic[sel] += 1
+            ip[sel] = cur + 1
+
+            op = ops[cur]
+            arg = args[cur]
+            cells = dp[sel]
+
+            if op == ADD:
+                mem[sel, cells] = (mem[sel, cells].astype(numpy.int64) + arg) & mask
+            elif op == MOVE:
+                cells += arg
+                ok = batch.bounds(sel, cells)
+                dp[sel[ok]] = cells[ok]
+            elif op == JNZ:
+                ip[sel[mem[sel, cells] != 0]] = arg + 1
+            elif op == JZ:
+                ip[sel[mem[sel, cells] == 0]] = arg + 1
+            elif op == CLEAR:
+                mem[sel, cells] = 0
+            elif op == MUL:
+                arg = self.factors[arg]
+                busy = mem[sel, cells] != 0
+                some, cells = sel[busy], cells[busy]
+                ok = batch.bounds(some, cells + arg[-1][0])
+                some, cells = some[ok], cells[ok]
+                ok = batch.bounds(some, cells + arg[0][0])
+                some, cells = some[ok], cells[ok]
+                mem = batch.mem
+                values = mem[some, cells].astype(numpy.int64)
+                for offset, factor in arg:
+                    target = cells + offset
+                    mem[some, target] = (mem[some, target].astype(numpy.int64) + values * factor) & mask
+                mem[some, cells] = 0
+            elif op == SCAN:
+                while True:
+                    inside = (cells >= 0) & (cells < mem.shape[1])
+                    moving = numpy.zeros(len(sel), bool)
+                    moving[inside] = mem[sel[inside], cells[inside]] != 0
+                    if not moving.any():
+                        break
+                    cells[moving] += arg
+                ok = batch.bounds(sel, cells)
+                dp[sel[ok]] = cells[ok]
+            elif op == OUT:
+                batch.out_rows.append(sel)
+                batch.out_values.append((mem[sel, cells] % 256).astype(numpy.uint8))
+            elif op == IN:
+                at = batch.pos[sel]
+                more = at < batch.lengths[sel]
+                values = batch.data[sel, numpy.minimum(at, batch.data.shape[1] - 1)].astype(numpy.int64)
+                if eof is not None:
+                    values[~more] = eof & mask
+                    mem[sel, cells] = values
+                else:
+                    mem[sel[more], cells[more]] = values[more]
+                batch.pos[sel] = at + more
+
+            done = sel[ip[sel] >= program_len]
+            if len(done):
+                batch.finish(done)
+            if batch.changed:
+                rows = batch.rows()
+
+        return batch.results()
+
+    def _compile(self, code):
+        """
+        Compile the filtered source into a list of (opcode, argument) tuples.
+        Runs of '+'/'-' and '>'/'<' are folded into a single ADD or MOVE with
+        the net amount (dropped if it is zero), and JZ/JNZ get the index of
+        their matching instruction as argument. Returns the program and a
+        list with the source position of each instruction.
+        """
+        program = []
+        positions = []
+        stack = []
+        code_len = len(code)
+        ip = 0
+        while ip < code_len:
+            op = code[ip]
+            start = ip
+            if op in '+-':
+                n = 0
+                while ip < code_len and code[ip] in '+-':
+                    n += 1 if code[ip] == '+' else -1
+                    ip += 1
+                if n:
+                    program.append((ADD, n))
+                    positions.append(start)
+                continue
+            elif op in '><':
+                n = 0
+                while ip < code_len and code[ip] in '><':
+                    n += 1 if code[ip] == '>' else -1
+                    ip += 1
+                if n:
+                    program.append((MOVE, n))
+                    positions.append(start)
+                continue
+            elif op == '[':
+                stack.append(len(program))
+                program.append((JZ, None))
+            elif op == ']':
+                sip = stack.pop()
+                program[sip] = (JZ, len(program))
+                program.append((JNZ, sip))
+            elif op == '.':
+                program.append((OUT, None))
+            elif op == ',':
+                program.append((IN, None))
+            elif op == '#':
+                program.append((DEBUG, None))
+            positions.append(start)
+            ip += 1
+        return program, positions
+
+    def _optimize(self, program, positions):
+        """
+        Replace innermost loops made only of ADD and MOVE instructions by a
+        single instruction when they match a known idiom:
+
+            [-] [+]         CLEAR
+            [->+>---<<]     MUL, with a tuple of (offset, factor) pairs
+            [>] [<<]        SCAN, with the step as argument
+
+        A MUL loop must leave the data pointer where it started and change
+        the current cell by exactly one per iteration. The factors are stored
+        already multiplied by the number of iterations per unit of the cell
+        value, so MUL adds value * factor to each target cell. Returns the
+        new program and positions with jump targets resolved again.
+        """
+        out = []
+        out_positions = []
+        stack = []
+        for (op, arg), pos in zip(program, positions):
+            if op == JZ:
+                stack.append(len(out))
+            elif op == JNZ:
+                sip = stack.pop()
+                idiom = self._idiom(out[sip+1:])
+                if idiom:
+                    del out[sip:]
+                    del out_positions[sip+1:]
+                    out.append(idiom)
+                    continue
+                out[sip] = (JZ, len(out))
+                arg = sip
+            out.append((op, arg))
+            out_positions.append(pos)
+        return out, out_positions
+
+    def _idiom(self, body):
+        """
+        Return the instruction equivalent to a loop with the given body or
+        None if the body is not a recognized idiom.
+        """
+        if len(body) == 1:
+            op, arg = body[0]
+            if op == ADD and arg in (1, -1):
+                return (CLEAR, None)
+            if op == MOVE:
+                return (SCAN, arg)
+            return None
+
+        offset = 0
+        deltas = {}
+        for op, arg in body:
+            if op == ADD:
+                deltas[offset] = deltas.get(offset, 0) + arg
+            elif op == MOVE:
+                offset += arg
+            else:
+                return None
+        if offset != 0 or deltas.get(0) not in (1, -1):
+            return None
+        step = -deltas.pop(0)
+        factors = tuple([(o, f * step) for o, f in sorted(deltas.items()) if f])
+        if not factors:
+            return (CLEAR, None)
+        return (MUL, factors)
 
-    def run(self, mem_size = 30000, max_op = 1000000, debug=False):
+    def run(self, mem_size = 30000, max_op = 1000000, debug=False, engine='interpreter', cell_bits=None, chunk_size=None, hooks=None, sparse=False):
         """
         Run the brainfuck code with a maximum number of instructions of
-        max_op (to counter infinite loops). If self.output is None, it
-        returns the output instead of directly writing to the file descriptor.
-        If debug is set to True, the interpreter will output debugging
-        information during execution.
+        max_op (to counter infinite loops). Instructions are counted on the
+        compiled program, so a run of '+' or '>' counts as a single one. If
+        self.output is None, it returns the output instead of directly
+        writing to the file descriptor. If debug is set to True, the
+        interpreter will output debugging information during execution.
+        hooks is a list of Hook objects (see Hook) to trace the execution;
+        debug=True is the same as adding a DebugHook.
+
+        The engine can be 'interpreter' (default) or 'codegen'. The latter
+        translates the program into a Python function the first time it is
+        used and keeps it in the instance, so later runs go straight to
+        native bytecode. Programs nested too deep for the Python compiler and
+        traced runs always use the interpreter.
+
+        mem_size is the maximum number of memory cells (None for no limit).
+        The tape starts small and grows as the program moves right; moving
+        left of the first cell or right of the last one raises a
+        BrainfuckError. With sparse set to True only the cells written to are
+        stored, for programs that use a few cells far apart.
+
+        Cells are unbounded Python ints by default. With cell_bits set to 8,
+        16 or 32 they wrap around and the tape is stored in a bytearray or
+        array, which is much smaller.
+
+        Output is kept in memory until the program ends unless chunk_size is
+        given, in which case it is written (and flushed) to self.output every
+        chunk_size characters.
+
+        After prepare(), untraced runs with the same tape settings start from
+        its snapshot instead of the first instruction (see prepare()).
         """
+        output = self.output
+        flush = getattr(output, 'flush', None) if chunk_size else None
+        for chunk in self._execute(mem_size, max_op, debug, engine, cell_bits, chunk_size, hooks, sparse):
+            output.write(chunk)
+            if flush:
+                flush()
+        if self.return_output:
+            result = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            return(result)
 
-        # Copy self references for speed.
-        code = self.code
-        input = self.input
+    def iter_output(self, chunk_size = 4096, **kwargs):
+        """
+        Generator running the program and yielding its output in chunks of
+        chunk_size characters as soon as they are produced (the last one may
+        be shorter). Takes the same keyword arguments as run(). Nothing is
+        written to self.output.
+        """
+        return self._execute(chunk_size=chunk_size, **kwargs)
+
+    def start(self, mem_size = 30000, max_op = 1000000, cell_bits = None, sparse = False):
+        """
+        Return a new BrainfuckState to run this program with resume().
+        """
+        return BrainfuckState(mem_size, cell_bits, max_op, sparse)
+
+    def resume(self, state, steps = None, debug = False, hooks = None):
+        """
+        Run the program from the given state for at most steps instructions
+        (until the end if None) with the interpreter, and update the state.
+        debug and hooks work as in run().
+        state.done tells whether the program has finished. Output is handled
+        as in run(): it is written to self.output or, if that was None,
+        the output of this slice is returned.
+        """
         output = self.output
-        jumps = self.jumps
-        code_len = self.code_len
- 
-        ic = 0                      # Instruction counter against infinite loops
-        mem = [0] * mem_size        # Memory
+        if debug:
+            hooks = (hooks or []) + [DebugHook()]
+        if not state.done:
+            if hooks:
+                chunks = self._trace(state, hooks, sys.maxint, steps)
+            else:
+                chunks = self._interpret(state, sys.maxint, steps)
+            for chunk in self._synced(chunks, state):
+                output.write(chunk)
+        if self.return_output:
+            result = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            return(result)
+
+    def profile(self, mem_size = 30000, max_op = 1000000, cell_bits = None, sparse = False):
+        """
+        Run the program with the interpreter, counting the executions of
+        every instruction, and return a BrainfuckProfile. Output is written
+        to self.output or, if that was None, kept in the profile's output.
+        """
+        state = BrainfuckState(mem_size, cell_bits, max_op, sparse)
+        counts = [0] * len(self.ops)
+        output = self.output
+        for chunk in self._synced(self._profile(state, counts)):
+            output.write(chunk)
+        result = None
+        if self.return_output:
+            result = output.getvalue()
+            output.seek(0)
+            output.truncate()
+        return BrainfuckProfile(self, counts, state.ic, state.m_dp + 1, result)
+
+    def _interpret(self, state, chunk_size, steps = None):
+        """
+        Generator running the program instruction by instruction from the
+        given state, for at most steps instructions if not None. The state
+        is updated when it stops.
+        """
+
+        # Copy self references for speed.
+        reader = self._reader
+        read = reader.read
+        eof = self.eof
+        ops, args = self._get_lists()
+        factors = self.factors
+        program_len = len(ops)
+        mem = state.mem
+        mask = state.mask
+        scan = scanner(mem)
+        grow = state.grow
+        mem_len = state.size
+        max_op = state.max_op
+
+        # Stop at whatever comes first, max_op or the end of the slice
+        limit = max_op
+        if steps is not None and state.ic + steps - 1 < max_op:
+            limit = state.ic + steps - 1
+
+        ic = state.ic               # Instruction counter against infinite loops
         buffer = []                 # Output buffer for tiny speed increase
-        ip = 0                      # Instruction pointer (current excecute place in code)
-        dp = 0                      # Data pointer (current read/write place in mem)
-        m_dp = 0                    # Maximum Data Pointer (largest memory index access by code)
- 
-        while ip < code_len:
+        ip = state.ip               # Instruction pointer (current excecute place in program)
+        dp = state.dp               # Data pointer (current read/write place in mem)
+        m_dp = state.m_dp           # Maximum Data Pointer (largest memory index access by code)
 
-            if ic > max_op:
-                raise BrainfuckError('Maximum number of instructions exceeded', 2)
- 
-            op = code[ip]
- 
-            if op == '+':
-                mem[dp] += 1
-            elif op == '-':
-                mem[dp] -= 1
-            elif op == '>': 
-                dp += 1
+        while ip < program_len:
+
+            if ic > limit:
+                if ic > max_op:
+                    raise BrainfuckError('Maximum number of instructions exceeded', 2)
+                break
+
+            op = ops[ip]
+            arg = args[ip]
+
+            if op == ADD:
+                mem[dp] = (mem[dp] + arg) & mask
+            elif op == MOVE:
+                dp += arg
                 if dp > m_dp:
                     m_dp = dp
-            elif op == '<': 
-                dp -= 1
+                    if dp >= mem_len:
+                        mem_len = grow(dp)
+                elif dp < 0:
+                    raise BrainfuckError('Data pointer underflow', 5)
+            elif op == JNZ:
+                if mem[dp] != 0:
+                    ip = arg
+            elif op == JZ:
+                if mem[dp] == 0:
+                    ip = arg
+            elif op == CLEAR:
+                mem[dp] = 0
+            elif op == MUL:
+                v = mem[dp]
+                if v:
+                    arg = factors[arg]
+                    top = dp + arg[-1][0]
+                    if top > m_dp:
+                        m_dp = top
+                        if top >= mem_len:
+                            mem_len = grow(top)
+                    if dp + arg[0][0] < 0:
+                        raise BrainfuckError('Data pointer underflow', 5)
+                    for offset, factor in arg:
+                        mem[dp + offset] = (mem[dp + offset] + v * factor) & mask
+                    mem[dp] = 0
+            elif op == SCAN:
+                dp = scan(dp, arg)
                 if dp > m_dp:
                     m_dp = dp
-            elif op == '[':
-                if mem[dp] == 0:
-                    ip = jumps[ip]
-            elif op == ']':
-                if mem[dp] != 0:
-                    ip = jumps[ip]
-            elif op == '.':
+                    if dp >= mem_len:
+                        mem_len = grow(dp)
+                elif dp < 0:
+                    raise BrainfuckError('Data pointer underflow', 5)
+            elif op == OUT:
                 buffer.append(chr(mem[dp] % 256))
-            elif op == ',':
+                if len(buffer) >= chunk_size:
+                    yield ''.join(buffer)
+                    buffer = []
+            elif op == IN:
                 try:
-                    mem[dp] = ord(input.read(1))
-                except:
-                    mem[dp] = -1
-            elif op == '#':
-                mem_ord = ['%3i ' % v for v in mem[:m_dp+1]]
-                mem_chr = [chr(v % 256) for v in mem[:m_dp+1]]
-                mem_ord[dp] = mem_ord[dp][0:3] + '*'
-                print mem_ord
- 
+                    mem[dp] = read()
+                except StopIteration:
+                    if reader.fill():
+                        read = reader.read
+                        mem[dp] = read()
+                    elif eof is not None:
+                        mem[dp] = eof & mask
+            elif op == DEBUG:
+                self._dump(mem, dp, m_dp)
+
             ip += 1
             ic += 1
- 
-            if debug:
-                sys.stdout.write(code + '    ')
-                for i in range(m_dp + 1):
-                    sys.stdout.write("%03i " % (mem[i]) )
-                sys.stdout.write("{%i} " % ic )
-                sys.stdout.write('\n')
-                print ' ' * ip + '^' + ' ' * (code_len - ip) + '   ' + '    ' * dp + '^^^'
-                sys.stdout.write('\n')
- 
-        output.write(''.join(buffer))
-        if self.return_output:
-            output.seek(0)
-            return(output.read())
+
+        state.ip, state.dp, state.m_dp, state.ic = ip, dp, m_dp, ic
+        state.done = ip >= program_len
+        if buffer:
+            yield ''.join(buffer)
+
+    # Variants of _interpret(), see engine()
+    _trace = engine(_interpret, '_trace', 'self, state, hooks, chunk_size, steps = None', """
+        Same as _interpret(), calling the hooks (see Hook) as it goes.
+        """, setup = TRACE_SETUP, debug = TRACE_DEBUG, after = TRACE_AFTER)
+
+    _profile = engine(_interpret, '_profile', 'self, state, counts, chunk_size = sys.maxint, steps = None', """
+        Same as _interpret(), adding one to counts[ip] for every instruction
+        executed. Kept apart so the normal interpreter loop does not pay for
+        it.
+        """, before = 'counts[ip] += 1')
+
+    def _execute(self, mem_size = 30000, max_op = 1000000, debug=False, engine='interpreter', cell_bits=None, chunk_size=None, hooks=None, sparse=False):
+        """
+        Return a generator running the program with the selected engine and
+        yielding the output every chunk_size characters and at the end.
+        """
+        if engine not in ('interpreter', 'codegen'):
+            raise BrainfuckError('Unknown engine %s' % engine, 3)
+        if not chunk_size:
+            chunk_size = sys.maxint
+
+        state = BrainfuckState(mem_size, cell_bits, max_op, sparse)
+
+        if debug:
+            hooks = (hooks or []) + [DebugHook()]
+        if hooks:
+            return self._synced(self._trace(state, hooks, chunk_size))
+
+        snapshot = self.snapshot
+        if snapshot and snapshot[:3] == (mem_size, cell_bits, sparse):
+            state = BrainfuckState.loads(snapshot[3])
+            if state.ic <= max_op and (state.done or engine == 'interpreter'):
+                state.max_op = max_op
+                return self._synced(self._snapshot_run(state, snapshot[4], chunk_size))
+            state = BrainfuckState(mem_size, cell_bits, max_op, sparse)
+
+        if engine == 'codegen':
+            function = self._function
+            if function is None:
+                function = self._function = self._build_function()
+            if function:
+                return self._synced(function(state, scanner(state.mem), self._reader, self.eof, max_op, chunk_size))
+        return self._synced(self._interpret(state, chunk_size))
+
+    def _synced(self, chunks, state = None):
+        """
+        Generator passing the chunks of an engine through and giving the
+        bytes it did not read back to the input once the run is over: when
+        the engine stops or fails, or, if a state is given, only when the
+        program is done, so a paused resume() slice keeps its input.
+        """
+        try:
+            for chunk in chunks:
+                yield chunk
+        except BaseException:
+            self._reader.sync()
+            raise
+        if state is None or state.done:
+            self._reader.sync()
+
+    def _snapshot_run(self, state, output, chunk_size):
+        """
+        Generator yielding the output of the snapshot and running the rest
+        of the program from its state.
+        """
+        for i in range(0, len(output), chunk_size):
+            yield output[i:i + chunk_size]
+        if not state.done:
+            for chunk in self._interpret(state, chunk_size):
+                yield chunk
+
+    def _dump(self, mem, dp, m_dp):
+        """
+        Print the memory up to m_dp, marking the cell at dp ('#' operator).
+        """
+        mem_ord = ['%3i ' % mem[i] for i in range(m_dp + 1)]
+        mem_ord[dp] = mem_ord[dp][0:3] + '*'
+        print mem_ord
+
+    def _build_function(self):
+        """
+        Compile the program into a Python generator function with the
+        signature f(state, scan, reader, eof, max_op, chunk_size), yielding the
+        output like _interpret() does. Loops become while statements and every
+        other instruction a line or two working on local variables. Returns
+        False if Python cannot compile the translation (too deeply nested).
+        """
+        source = self._codegen()
+        namespace = {'BrainfuckError': BrainfuckError, 'dump': self._dump}
+        try:
+            exec compile(source, '<brainfuck>', 'exec') in namespace
+        except (SyntaxError, MemoryError, RuntimeError):
+            return False
+        return namespace['program']
+
+    def _codegen(self):
+        """
+        Translate the program into Python source. The instruction counter is
+        increased and checked against max_op once per straight run of
+        instructions, so the run stops where the interpreter would: before
+        an instruction that starts with more than max_op executed.
+        """
+        ops = self.ops
+        args = self.args
+        lines = ['def program(state, scan, reader, eof, max_op, chunk_size):',
+                 '    read = reader.read', '    mem = state.mem', '    mask = state.mask', '    grow = state.grow',
+                 '    mem_len = state.size', '    dp = 0', '    m_dp = 0', '    ic = 0', '    limit = max_op + 1',
+                 '    buffer = []']
+        indent = '    '
+        underflow = "raise BrainfuckError('Data pointer underflow', 5)"
+
+        # Number of instructions in each straight run, including the JZ
+        # closing it and, at the end of a loop body, its JNZ.
+        counts = {}
+        start = 0
+        for ip, op in enumerate(ops):
+            if op in (JZ, JNZ):
+                counts[start] = ip - start + 1
+                start = ip + 1
+        counts[start] = len(ops) - start
+
+        for ip, (op, arg) in enumerate(zip(ops, args)):
+            if ip in counts and counts[ip]:
+                lines.append(indent + 'ic += %i' % counts[ip])
+                lines.append(indent + 'if ic > limit:')
+                lines.append(indent + "    raise BrainfuckError('Maximum number of instructions exceeded', 2)")
+            if op == ADD:
+                lines.append(indent + 'mem[dp] = (mem[dp] + %i) & mask' % arg)
+            elif op == MOVE:
+                lines.append(indent + 'dp += %i' % arg)
+                if arg > 0:
+                    lines.append(indent + 'if dp > m_dp:')
+                    lines.append(indent + '    m_dp = dp')
+                    lines.append(indent + '    if dp >= mem_len: mem_len = grow(dp)')
+                else:
+                    lines.append(indent + 'if dp < 0: ' + underflow)
+            elif op == JZ:
+                lines.append(indent + 'while mem[dp]:')
+                indent += '    '
+            elif op == JNZ:
+                indent = indent[:-4]
+            elif op == OUT:
+                lines.append(indent + 'buffer.append(chr(mem[dp] % 256))')
+                lines.append(indent + 'if len(buffer) >= chunk_size:')
+                lines.append(indent + "    yield ''.join(buffer)")
+                lines.append(indent + '    buffer = []')
+            elif op == IN:
+                lines.append(indent + 'try:')
+                lines.append(indent + '    mem[dp] = read()')
+                lines.append(indent + 'except StopIteration:')
+                lines.append(indent + '    if reader.fill():')
+                lines.append(indent + '        read = reader.read')
+                lines.append(indent + '        mem[dp] = read()')
+                lines.append(indent + '    elif eof is not None:')
+                lines.append(indent + '        mem[dp] = eof & mask')
+            elif op == DEBUG:
+                lines.append(indent + 'dump(mem, dp, m_dp)')
+            elif op == CLEAR:
+                lines.append(indent + 'mem[dp] = 0')
+            elif op == MUL:
+                arg = self.factors[arg]
+                lines.append(indent + 'v = mem[dp]')
+                lines.append(indent + 'if v:')
+                if arg[-1][0] > 0:
+                    lines.append(indent + '    if dp + %i > m_dp:' % arg[-1][0])
+                    lines.append(indent + '        m_dp = dp + %i' % arg[-1][0])
+                    lines.append(indent + '        if m_dp >= mem_len: mem_len = grow(m_dp)')
+                if arg[0][0] < 0:
+                    lines.append(indent + '    if dp < %i: %s' % (-arg[0][0], underflow))
+                for offset, factor in arg:
+                    lines.append(indent + '    mem[dp + %i] = (mem[dp + %i] + v * %i) & mask' % (offset, offset, factor))
+                lines.append(indent + '    mem[dp] = 0')
+            elif op == SCAN:
+                lines.append(indent + 'dp = scan(dp, %i)' % arg)
+                lines.append(indent + 'if dp > m_dp:')
+                lines.append(indent + '    m_dp = dp')
+                lines.append(indent + '    if dp >= mem_len: mem_len = grow(dp)')
+                lines.append(indent + 'elif dp < 0: ' + underflow)
+        lines.append('    if buffer:')
+        lines.append("        yield ''.join(buffer)")
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class Scheduler(object):
+    """
+    Cooperative scheduler running many programs in the same process. Each
+    program runs for at most 'steps' instructions before the next one gets
+    its turn, so a program stuck in an infinite loop only delays the others
+    until it reaches its max_op.
+
+    Example:
+        scheduler = Scheduler(steps = 1000)
+        scheduler.add(Brainfuck(code1, '62'))
+        scheduler.add(Brainfuck(code2, ''), max_op = 50000)
+        print scheduler.run()   # [output1, output2 or BrainfuckError]
+    """
+
+    def __init__(self, steps = 10000):
+        self.steps = steps
+        self.tasks = []
+
+    def add(self, bf, **kwargs):
+        """
+        Schedule a Brainfuck instance. Keyword arguments are those of
+        Brainfuck.start(). Returns the BrainfuckState of the task.
+        """
+        state = bf.start(**kwargs)
+        self.tasks.append((bf, state))
+        return state
+
+    def __iter__(self):
+        """
+        Run the scheduled programs in turns, yielding (index, output) after
+        every slice, where index is the position of the program in the order
+        they were added and output the output of the slice, or the
+        BrainfuckError that stopped it.
+        """
+        pending = range(len(self.tasks))
+        while pending:
+            still = []
+            for index in pending:
+                bf, state = self.tasks[index]
+                try:
+                    output = bf.resume(state, self.steps)
+                except BrainfuckError, e:
+                    yield index, e
+                    continue
+                yield index, output
+                if not state.done:
+                    still.append(index)
+            pending = still
+
+    def run(self):
+        """
+        Run all the scheduled programs to the end and return the list of
+        their outputs (or errors) in the order they were added.
+        """
+        results = [''] * len(self.tasks)
+        for index, output in self:
+            if isinstance(output, BrainfuckError):
+                results[index] = output
+            elif output:
+                results[index] += output
+        return results
+
+
+# Program and run() arguments of the current pool worker (see run_many)
+_worker = None
+
+def _pool_init(bf, kwargs):
+    global _worker
+    if kwargs.get('engine') == 'codegen':
+        bf._function = bf._build_function()
+    _worker = (bf, kwargs)
+
+def _pool_run(input):
+    bf, kwargs = _worker
+    return bf._with_input(input).run(**kwargs)
 
 
 if __name__ == '__main__':
@@ -176,10 +1678,15 @@ if __name__ == '__main__':
     import getopt
 
     debug = False
+    profile = None
+    trace = None
+    view = None
+    cache_dir = None
+    eof = -1
     code = None
     
     try:                                
-        opts, args = getopt.getopt(sys.argv[1:], "hds:", ["help", "debug", "source="])
+        opts, args = getopt.getopt(sys.argv[1:], "hds:p:t:c:e:", ["help", "debug", "source=", "profile=", "trace=", "view=", "cache=", "eof="])
     except getopt.GetoptError:
         print "Wrong parameters."
         sys.exit(2)
@@ -192,11 +1699,28 @@ if __name__ == '__main__':
             if not os.path.exists(arg):
                 print "File '%s' does not exist" % arg
                 sys.exit(2)
-            f = open(arg, 'r')
-            code = f.read()
-            f.close()
+            code = load_source(arg)
         elif opt in ('-d', '--debug'):
             debug = True
+        elif opt in ('-p', '--profile'):
+            if arg not in ('text', 'json'):
+                print "Profile format must be 'text' or 'json'"
+                sys.exit(2)
+            profile = arg
+        elif opt in ('-t', '--trace'):
+            trace = arg
+        elif opt == '--view':
+            view = arg
+        elif opt in ('-c', '--cache'):
+            if not os.path.isdir(arg):
+                print "Cache directory '%s' does not exist" % arg
+                sys.exit(2)
+            cache_dir = arg
+        elif opt in ('-e', '--eof'):
+            if arg not in ('0', '-1', 'unchanged'):
+                print "EOF must be '0', '-1' or 'unchanged'"
+                sys.exit(2)
+            eof = None if arg == 'unchanged' else int(arg)
 
     if len(args):
         code = args[0]
@@ -205,6 +1729,30 @@ if __name__ == '__main__':
         print "No code!"
         sys.exit(2)
     
-    output = Brainfuck(code).run(debug=debug)
+    if view:
+        f = open(view, 'rb')
+        data = f.read()
+        f.close()
+        for line in render_trace(data, Brainfuck(code).code):
+            print line
+        sys.exit()
+
+    if trace:
+        f = open(trace, 'wb')
+        output = Brainfuck(code, cache_dir=cache_dir, eof=eof).run(hooks=[TraceRecorder(f)])
+        f.close()
+        print output
+        sys.exit()
+
+    if profile:
+        result = Brainfuck(code, cache_dir=cache_dir, eof=eof).profile()
+        print result.output
+        if profile == 'json':
+            sys.stderr.write(result.json() + '\n')
+        else:
+            sys.stderr.write(result.report() + '\n')
+        sys.exit()
+
+    output = Brainfuck(code, cache_dir=cache_dir, eof=eof).run(debug=debug)
     print output
 
@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 
-from xbf import Brainfuck
+import os
+import shutil
+import tempfile
+import itertools
+
+import bfcg
+from bf import Brainfuck, BrainfuckState, Hook, numpy
 
 tests = (
     ('helloworld', '++++++++++[>+++++++>++++++++++>+++>+<<<<-]>++.>+.+++++++..+++.>++.<<+++++++++++++++.>.+++.------.--------.>+.>.', '', 'Hello World!\n'),
     ('divide1', ',>,>++++++[-<--------<-------->>]<<[>[->+>+<<]>[-<<-[>]>>>[<[>>>-<<<[-]]>>]<<]>>>+<<[-<<+>>]<<<]>[-]>>>>[-<<<<<+>>>>>]<<<<++++++[-<++++++++>]<.', '62', '3'),
     ('divide2', ',>,>++++++[-<--------<-------->>]<<[>[->+>+<<]>[-<<-[>]>>>[<[>>>-<<<[-]]>>]<<]>>>+<<[-<<+>>]<<<]>[-]>>>>[-<<<<<+>>>>>]<<<<++++++[-<++++++++>]<.', '92', '4'),
+    ('cat', ',+[-.,+]', 'Hello World!\n', 'Hello World!\n'),
 )
 
 for test in tests:
@@ -15,6 +22,151 @@ for test in tests:
     else:
         print "Test %-20s: Success" % ('\''+test[0]+'\'')
 
+# The same tests through every other way of running a program, which must
+# all give the same output as run()
+cache_dir = tempfile.mkdtemp()
+
+def cached(code, input):
+    Brainfuck(code, input, cache_dir=cache_dir).run()
+    return Brainfuck(code, input, cache_dir=cache_dir).run()
+
+def resumed(code, input):
+    bf = Brainfuck(code, input)
+    state = bf.start()
+    output = ''
+    while not state.done:
+        output += bf.resume(state, 7)
+        state = BrainfuckState.loads(state.dumps())
+    return output
+
+modes = (
+    ('codegen', lambda code, input: Brainfuck(code, input).run(engine='codegen')),
+    ('unoptimized', lambda code, input: Brainfuck(code, input, optimize=False).run()),
+    ('cells-8', lambda code, input: Brainfuck(code, input).run(cell_bits=8)),
+    ('cells-16', lambda code, input: Brainfuck(code, input).run(cell_bits=16)),
+    ('cells-32', lambda code, input: Brainfuck(code, input).run(cell_bits=32)),
+    ('sparse', lambda code, input: Brainfuck(code, input).run(sparse=True)),
+    ('trace', lambda code, input: Brainfuck(code, input).run(hooks=[Hook()])),
+    ('cache', cached),
+    ('resume', resumed),
+    ('profile', lambda code, input: Brainfuck(code, input).profile().output),
+    ('run-many', lambda code, input: Brainfuck(code).run_many([input, input], processes=2)[1]),
+)
+
+for mode in modes:
+    failed = [test[0] for test in tests if mode[1](test[1], test[2]) != test[3]]
+    if failed:
+        print "Test %-20s: Failed. %s" % ('\''+mode[0]+'\'', ', '.join(failed))
+    else:
+        print "Test %-20s: Success" % ('\''+mode[0]+'\'')
+
+shutil.rmtree(cache_dir)
+
+# ',' at the end of the input stores the EOF value, or nothing with None
+eof_tests = (
+    ('eof-0', 0, None, 'ab\x00'),
+    ('eof-minus-1', -1, 8, 'ab\xff'),
+    ('eof-none', None, None, 'abb'),
+)
+
+for test in eof_tests:
+    output = Brainfuck(',.,.,.', 'ab', eof=test[1]).run(cell_bits=test[2])
+    if output != test[3]:
+        print "Test %-20s: Failed. Output = %r" % ('\''+test[0]+'\'', output)
+    else:
+        print "Test %-20s: Success" % ('\''+test[0]+'\'')
+
+# Programs prepared up to their first input must run as if they were not.
+# widths prints 1 before reading with unbounded cells and 0 with 8 bits.
+widths = '+' * 256 + '[>+<[-]]>.,.'
+
+def prepared(code, input, cache_dir = None, **kwargs):
+    bf = Brainfuck(code, input, cache_dir=cache_dir)
+    bf.prepare(**kwargs)
+    state = BrainfuckState.loads(bf.snapshot[3])
+    return state.ip > 0, state.done, bf.run()
+
+def prepared_cached(code, input):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        Brainfuck(code, '', cache_dir=cache_dir).prepare()
+        bf = Brainfuck(code, input, cache_dir=cache_dir)
+        state = BrainfuckState.loads(bf.snapshot[3])
+        return state.ip > 0, state.done, bf.run()
+    finally:
+        shutil.rmtree(cache_dir)
+
+prepare_tests = (
+    ('prepare-no-input', lambda: prepared(tests[0][1], ''), (True, True, tests[0][3])),
+    ('prepare-input', lambda: prepared(widths, 'x'), (True, False, '\x01x')),
+    ('prepare-cell-bits', lambda: prepared(widths, 'x', cell_bits=8), (True, False, '\x01x')),
+    ('prepare-mem-size', lambda: prepared(widths, 'x', mem_size=100), (True, False, '\x01x')),
+    ('prepare-cache', lambda: prepared_cached(widths, 'x'), (True, False, '\x01x')),
+)
+
+for test in prepare_tests:
+    output = test[1]()
+    if output != test[2]:
+        print "Test %-20s: Failed. Output = %r" % ('\''+test[0]+'\'', output)
+    else:
+        print "Test %-20s: Success" % ('\''+test[0]+'\'')
+
+# Batch runs of the samples must give the same outputs (or errors) as run()
+samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+inputs = ('', '62', '84\n36\n', '123\n', '7\n3\n')
+for name in sorted(os.listdir(samples)):
+    if numpy is None:
+        print "Test %-20s: Skipped, no NumPy" % ('\''+name+'\'')
+        continue
+    code = open(os.path.join(samples, name)).read().replace('#', '')
+    expected = []
+    for input in inputs:
+        try:
+            expected.append(Brainfuck(code, input, eof=0).run(max_op=10000, cell_bits=8))
+        except Exception, e:
+            expected.append(e)
+    outputs = Brainfuck(code, eof=0).run_batch(inputs, max_op=10000, cell_bits=8)
+    if map(str, outputs) != map(str, expected):
+        print "Test %-20s: Failed. Output = %s" % ('\''+name+'\'', outputs)
+    else:
+        print "Test %-20s: Success" % ('\''+name+'\'')
 
+# BFCG sources, compiled with every combination of the compiler options and
+# run. Every combination must give the same output.
+bfcg_tests = (
+    ('hello', "'Hello World!\n' PRINT_STR_AND_CLEAN", '', 'Hello World!\n'),
+    ('print-clean', "'\x10Z\n' PRINT_STR_AND_CLEAN 7 PRINT_NUM", '', '\x10Z\n7'),
+    ('mul', "100 3 MUL PRINT_NUM LF", '', '300\n'),
+    ('arith', "2 3 DUP MUL ADD PRINT_NUM LF", '', '11\n'),
+    ('div', "17 5 DIV PRINT_NUM ' ' PRINT_STR_AND_CLEAN PRINT_NUM", '', '2 3'),
+    ('rot', "1 2 3 ROT SWAP PRINT_NUM PRINT_NUM PRINT_NUM", '', '312'),
+    ('while', "5 DUP WHILE DEC DUP ENDWHILE DROP '*' PRINT_STR_AND_CLEAN", '', '*'),
+    ('read', "READ_NUM 1 ADD PRINT_NUM LF", '41\n', '42\n'),
+    ('gcd', "READ_NUM READ_NUM DUP IF NDUP 2 DIV SWAPDROP DUP PREVIOUS ENDIF PREVIOUS 'GCD: ' PRINT_STR_AND_CLEAN PRINT_NUM LF", '84\n36\n', 'GCD: 12\n'),
+)
+
+for test in bfcg_tests:
+    failed = []
+    for optimize, fold, plan, objective in itertools.product((True, False), (True, False), (True, False), bfcg.OBJECTIVES):
+        options = {'optimize': optimize, 'fold': fold, 'plan': plan, 'objective': objective}
+        output = Brainfuck(bfcg.compile(test[1], options), test[2], eof=0).run()
+        if output != test[3]:
+            failed.append((options, output))
+    if failed:
+        print "Test %-20s: Failed. %s: Output = %s" % ('\''+test[0]+'\'', failed[0][0], failed[0][1])
+    else:
+        print "Test %-20s: Success" % ('\''+test[0]+'\'')
 
+# Unbalanced IF is compiled as far as it goes
+try:
+    bfcg.compile('IF')
+    print "Test %-20s: Success" % '\'unbalanced-if\''
+except Exception, e:
+    print "Test %-20s: Failed. %s" % ('\'unbalanced-if\'', e)
 
+# Line width must be positive
+try:
+    bfcg.compile('1', {'linewrap': -1})
+    print "Test %-20s: Failed. No error" % '\'negative-linewrap\''
+except ValueError:
+    print "Test %-20s: Success" % '\'negative-linewrap\''
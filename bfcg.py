@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
+import os
 import re
 import sys
 import shlex
 import math
+import hashlib
+import bisect
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import bf
 
 # -----------------------------------------------------------------------------
 
@@ -38,6 +45,80 @@ operators['CLR'] = { "code": "<[-]" }
 operators['BOL'] = { "code": "<[<]>" }
 operators['EOL'] = { "code": "[>]" }
 
+# -----------------------------------------------------------------------------
+# COST MODEL
+# -----------------------------------------------------------------------------
+
+# Objectives to choose among the implementations of an operator: the
+# shortest code, the fewest executed instructions or the lowest sum of both
+OBJECTIVES = ('size', 'speed', 'balanced')
+
+# Value of the stack cells set up to measure the operators working on them
+MEASURE_VALUE = 10
+
+def lru_cache(size, key = None):
+    '''
+    Decorator memoizing a function of hashable arguments, keeping the
+    results of the last 'size' different calls. If given, key is called
+    with the arguments and its result used as the cache key instead
+    '''
+    def decorator(f):
+        cache = OrderedDict()
+        def wrapper(*args):
+            k = key(*args) if key else args
+            try:
+                value = cache.pop(k)
+            except KeyError:
+                value = f(*args)
+                if len(cache) >= size:
+                    cache.popitem(last = False)
+            cache[k] = value
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+# Measured steps are kept by digest, as the codes can be long
+@lru_cache(4096, key = lambda code: hashlib.sha1(code).digest())
+def measure_steps(code):
+    '''
+    Runs the code with the bf.py interpreter, without its loop optimizer
+    and with an unlimited tape, and returns the number of BF instructions
+    executed
+    '''
+    program = bf.Brainfuck(code, input = StringIO(), optimize = False)
+    profile = program.profile(mem_size = None, max_op = 100000000)
+    steps = 0
+    for op, arg, count in zip(program.ops, program.args, profile.counts):
+        if op in (bf.ADD, bf.MOVE):
+            count *= abs(arg)
+        steps += count
+    return steps
+
+def objective_key(length, steps, objective):
+    '''
+    Returns the sorting key of a code of the given length and executed
+    steps for an objective
+    '''
+    if objective == 'speed':
+        return (steps, length)
+    if objective == 'balanced':
+        return (length + steps, length)
+    return (length, steps)
+
+def choose_variant(variants, objective, prefix = ''):
+    '''
+    Returns the best of a list of codes for the objective. The steps of
+    each one are measured running it after prefix, which sets up the cells
+    it works on. For 'size' the first of the shortest codes is returned
+    without running anything.
+    '''
+    if objective == 'size':
+        return min(variants, key = len)
+    base = measure_steps(prefix)
+    return min(variants, key = lambda code:
+        objective_key(len(code), measure_steps(prefix + code) - base, objective))
+
 # -----------------------------------------------------------------------------
 # FLOW CONTROL
 # -----------------------------------------------------------------------------
@@ -95,7 +176,64 @@ operators['DROPSWAP'] = { "code" : "<[-]<[>+<-]>>" }
 operators['DROP'] = { "code" : "<[-]" }
 operators['ROT'] = { "code" : "<<<[>>>+<<<-]>[<+>-]>[<+>-]>[<+>-]" }
 
-def stack_ndup(n=1):
+def stack_arrange(layout):
+    '''
+    Rearranges the cells at the top of the stack. layout has a character per
+    cell, from the lowest one: the new position of its value (counting from
+    the lowest cell) or 'x' to drop it. Every value is moved once, plus one
+    more move through the free cell above the stack for each cycle. "10" is
+    SWAP, "201" is ROT and "x0" is SWAPDROP.
+    '''
+    size = len(layout)
+    moves = {}              # Source cell by destination cell
+    full = set()            # Cells holding a value
+    buffer = []
+    pos = [size]
+
+    def goto(cell):
+        buffer.append(flow_move(cell - pos[0]) or '')
+        pos[0] = cell
+
+    def transfer(src, dst):
+        goto(src)
+        buffer.append("[")
+        goto(dst)
+        buffer.append("+")
+        goto(src)
+        buffer.append("-]")
+
+    for cell, target in enumerate(layout):
+        if target == 'x':
+            goto(cell)
+            buffer.append("[-]")
+            continue
+        full.add(cell)
+        if int(target) != cell:
+            moves[int(target)] = cell
+
+    while moves:
+        ready = [dst for dst in moves if dst not in full]
+        if not ready:
+            # Only cycles left, park the lowest value in the free cell
+            cell = min(moves)
+            transfer(cell, size)
+            for dst, src in moves.items():
+                if src == cell:
+                    moves[dst] = size
+            full.remove(cell)
+            full.add(size)
+            continue
+        dst = min(ready, key = lambda dst: (abs(moves[dst] - pos[0]), dst))
+        src = moves.pop(dst)
+        transfer(src, dst)
+        full.remove(src)
+        full.add(dst)
+
+    goto(len(layout) - layout.count('x'))
+    return ''.join(buffer)
+operators['ARRANGE'] = { "callable": stack_arrange, "parameters": 1 }
+
+def stack_ndup_unrolled(n=1):
 
     n = int(n)
 
@@ -117,104 +255,189 @@ def stack_ndup(n=1):
     buffer.append("-]")
 
     return ''.join(buffer) * n
-operators['NDUP'] = { "callable": stack_ndup, "parameters": 1 }
-operators['DUP'] = { "callable": stack_ndup, "parameters": 0 }
+
+def stack_ndup_loop(n=1):
+    '''
+    Same as stack_ndup_unrolled() with a loop instead of n copies of the
+    code. The counter is moved one cell to the right on every iteration to
+    leave room for the copy.
+    '''
+    n = int(n)
+    buffer = []
+    buffer.append(">" + "+" * n)
+    buffer.append("[-[>+<-]>")
+    buffer.append("<" * (n+2))
+    buffer.append("[")
+    buffer.append(">" * n)
+    buffer.append("+>+")
+    buffer.append("<" * (n+1))
+    buffer.append("-]")
+    buffer.append(">" * (n+1))
+    buffer.append("[")
+    buffer.append("<" * (n+1))
+    buffer.append("+")
+    buffer.append(">" * (n+1))
+    buffer.append("-]>]<")
+    return ''.join(buffer)
+
+def stack_ndup(n=1, objective='size'):
+    '''
+    Duplicates the n elements on top of the stack
+    '''
+    n = int(n)
+    prefix = ("+" * MEASURE_VALUE + ">") * n
+    return choose_variant([stack_ndup_unrolled(n), stack_ndup_loop(n)], objective, prefix)
+operators['NDUP'] = { "callable": stack_ndup, "parameters": 1, "objective": True }
+operators['DUP'] = { "callable": stack_ndup, "parameters": 0, "objective": True }
 
 # -----------------------------------------------------------------------------
 # LOAD_NUM
 # -----------------------------------------------------------------------------
 
-def load_num_lineal(n):
-    return "+" * n
-
-def load_num_sqrt(n):
-    
-    # Initialize buffer
+def load_num_nested(factors, rest):
+    '''
+    Builds the code for n = f1 * f2 * ... * fm + rest, using m-1 nested
+    loops on the cells to the right of the cursor as counters. With a single
+    factor it is just a run of '+' (or '-').
+    '''
     buffer = []
+    depth = len(factors) - 1
+    buffer.append(">" * depth)
+    buffer.append("+" * factors[0])
+    for factor in factors[1:]:
+        buffer.append("[<")
+        buffer.append("+" * factor)
+    buffer.append(">-]" * depth)
+    buffer.append("<" * depth)
+    if rest > 0:
+        buffer.append("+" * rest)
+    elif rest < 0:
+        buffer.append("-" * -rest)
+    return ''.join(buffer)
 
-    # Find the closes square root
-    r=int(math.sqrt(n))
-    if r>=15:
-        r=15
-    else:
-        d=n-r*r
-        if 2*(d-r)>3: 
-            r+=1
-    d=n-r*r
-
-    # Output the square root calculation
-    buffer.append(">")
-    buffer.append("+" * r)
-    buffer.append("[<")
-    buffer.append("+" * r)
-    buffer.append(">-]")
-    buffer.append("<")
-
-    # Output the rest
-    if d > 0:
-        buffer.append("+" * d)
-    elif d < 0:
-        buffer.append("-" * -d)
-
-    return ''.join(buffer)    
-
-def load_num_cluster(n, cluster_size = 16):
-
-    # Initialize buffer
+def load_num_cost(factors, rest):
+    '''
+    Returns the (length, executed steps) of load_num_nested(factors, rest)
+    without building it.
+    '''
+    depth = len(factors) - 1
+    length = sum(factors) + 7 * depth + abs(rest)
+
+    # Every loop is entered once and each iteration runs '<', the next
+    # factor, the inner loop if any and '>-]'
+    steps = 0
+    for i in range(depth, 0, -1):
+        steps = 1 + factors[i-1] * (1 + factors[i] + steps + 3)
+    steps += 2 * depth + factors[0] + abs(rest)
+    if not depth:
+        steps = length
+    return length, steps
+
+# Prefix factors tried by load_num_search() for each number of loops
+SEARCH_LIMIT = 4096
+
+def load_num_search(n, objective = 'size', depth = 3):
+    '''
+    Searches the decompositions n = f1 * ... * fm + rest with up to 'depth'
+    nested loops for the one with the lowest cost for the objective (see
+    objective_key()), using the estimates of load_num_cost(). The
+    factors before the last one are searched up to about twice the m-th
+    root of n (fewer if there would be more than SEARCH_LIMIT), the last
+    one is rounded both ways so rest can be positive or negative. Prefixes
+    that can not beat the best candidate, as every factor costs at least
+    its value in length and steps, are skipped. Returns (factors, rest).
+    '''
+    def key(candidate):
+        length, steps = load_num_cost(*candidate)
+        return objective_key(length, steps, objective)
+
+    best = ([n], 0)
+    best_key = key(best)
+    for m in range(2, depth + 2):
+        bound = max(2, int(round(n ** (1.0 / m))) * 2 + 2)
+        bound = min(bound, max(2, int(SEARCH_LIMIT ** (1.0 / (m - 1)))))
+
+        # Depth first over the prefixes, each factor in increasing order
+        stack = [[]]
+        while stack:
+            prefix = stack.pop()
+            lower = sum(prefix) + 2 * (m - 1 - len(prefix)) + 1 + 7 * (m - 1)
+            if objective_key(lower, lower, objective) >= best_key:
+                continue
+            if len(prefix) < m - 1:
+                for f in range(bound, 1, -1):
+                    stack.append(prefix + [f])
+                continue
+            product = 1
+            for f in prefix:
+                product *= f
+            last = n // product
+            for f in (last, last + 1):
+                if f < 1:
+                    continue
+                candidate = (prefix + [f], n - product * f)
+                candidate_key = key(candidate)
+                if candidate_key < best_key:
+                    best, best_key = candidate, candidate_key
+    return best
+
+# Numbers from this one on are loaded with load_num_horner(), as the code of
+# the nested loops grows with a root of the number
+LOAD_NUM_LIMIT = 1 << 17
+
+def load_num_horner(n, base = 16):
+    '''
+    Builds the code for n from its digits in the given base, multiplying
+    the cell by the base (through the cell to its right) before adding each
+    digit after the first one. The code grows with the number of digits.
+    '''
+    digits = []
+    while n:
+        digits.append(n % base)
+        n //= base
+    digits.reverse()
     buffer = []
+    for i, digit in enumerate(digits):
+        if i:
+            buffer.append("[>" + "+" * base + "<-]>[<+>-]<")
+        buffer.append("+" * digit)
+    return ''.join(buffer)
 
-    # Find the closes cluster start
-    s = int(n / cluster_size)
-    d = n-s*cluster_size
-    if 2 * d - cluster_size > 2:
-        s += 1
-        d = n-s*cluster_size
-
-    # Output the cluster
-    buffer.append(">")
-    buffer.append("+" * cluster_size)
-    buffer.append("[<")
-    buffer.append("+" * s)
-    buffer.append(">-]")
-    buffer.append("<")
-
-    # Output the rest
-    if d > 0:
-        buffer.append("+" * d)
-    elif d < 0:
-        buffer.append("-" * -d)
-    
-    return ''.join(buffer)    
+def load_num_code(n, objective = 'size'):
+    '''
+    Returns the code loading n on the cursor cell for the objective
+    '''
+    if n >= LOAD_NUM_LIMIT:
+        return load_num_horner(n)
+    return load_num_nested(*load_num_search(n, objective))
 
-def load_num_cluster_8(n):
-    return load_num_cluster(n, 8)
+# Memoized searches, by (number, objective)
+load_num_cache = {}
 
-def load_num_cluster_16(n):
-    return load_num_cluster(n, 16)
+def load_num_table(objective = 'size', size = 256):
+    '''
+    Runs the search for every number below size and returns the list of
+    codes. load_num() fills the same table one number at a time, as they are
+    used.
+    '''
+    for n in range(size):
+        if (n, objective) not in load_num_cache:
+            load_num_cache[(n, objective)] = load_num_code(n, objective)
+    return [load_num_cache[(n, objective)] for n in range(size)]
 
-def load_num(n):
+def load_num(n, objective = 'size'):
     '''
-    Calculates the shortest BF code to load a given number
+    Calculates the best BF code to load a given number for the objective:
+    the shortest ('size'), the fastest to run ('speed') or the lowest sum
+    of both ('balanced')
     '''
     n = int(n)
-    
-    # Start values
-    code = None
-    min = 1000
-
-    for f in [ 
-        load_num_lineal, 
-        load_num_sqrt, 
-        load_num_cluster_8,
-        load_num_cluster_16,
-    ]:
-        tmp = f(n)
-        if len(tmp) < min:
-            code = tmp
-            min = len(tmp)
-
-    return "%s>" % code
-operators['LOAD_NUM'] = { "callable": load_num, "parameters": 1 }
+
+    if (n, objective) not in load_num_cache:
+        load_num_cache[(n, objective)] = load_num_code(n, objective)
+
+    return "%s>" % load_num_cache[(n, objective)]
+operators['LOAD_NUM'] = { "callable": load_num, "parameters": 1, "objective": True }
 
 # -----------------------------------------------------------------------------
 # PRINT_STR_AND_CLEAN
@@ -278,17 +501,181 @@ def print_str_and_clean_cluster(s, cluster_size = 16):
         # Print it
         buffer.append(".")
 
-    # Move to the end and clean
+    # Move to the end and clean. CLEAN stops at the first zero cell, so if
+    # any cell ended at zero clear them one by one instead.
     buffer.append(">" * (len(positions)-cursor))
-    buffer.append(operators['CLEAN']['code'])
-    buffer.append("<")
+    if 0 in positions:
+        buffer.append("<[-]" * len(positions))
+        buffer.append("<<")
+    else:
+        buffer.append(operators['CLEAN']['code'])
+        buffer.append("<")
     
     # Return result
     return ''.join(buffer)
 
-def print_str_and_clean(s):
-    return print_str_and_clean_cluster(s, 16)
-operators['PRINT_STR_AND_CLEAN'] = { "callable": print_str_and_clean, "parameters": 1 }
+def str_centers(characters, count):
+    '''
+    Splits the character values into groups minimizing the sum of distances
+    of every character to the median of its group, with dynamic programming
+    over the sorted distinct values. Returns a list with the medians of the
+    best split for each number of groups from 1 to count.
+    '''
+
+    # Frequencies and prefix sums over the sorted distinct values
+    frequencies = {}
+    for c in characters:
+        frequencies[c] = frequencies.get(c, 0) + 1
+    values = sorted(frequencies)
+    size = len(values)
+    weights = [0]
+    sums = [0]
+    for v in values:
+        weights.append(weights[-1] + frequencies[v])
+        sums.append(sums[-1] + frequencies[v] * v)
+
+    def median(a, b):
+        # Index of the weighted median of values[a..b]
+        target = weights[a] + (weights[b+1] - weights[a] + 1) / 2
+        return bisect.bisect_left(weights, target, a + 1, b + 2) - 1
+
+    def cost(a, b):
+        m = median(a, b)
+        v = values[m]
+        return v * (weights[m+1] - weights[a]) - (sums[m+1] - sums[a]) \
+            + (sums[b+1] - sums[m+1]) - v * (weights[b+1] - weights[m+1])
+
+    # best[j][b]: cost of splitting values[0..b] into j+1 groups, and the
+    # start of the last group
+    count = min(count, size)
+    best = [[(cost(0, b), 0) for b in range(size)]]
+    for j in range(1, count):
+        previous = best[-1]
+        row = []
+        for b in range(size):
+            row.append(min([(previous[a-1][0] + cost(a, b), a) for a in range(max(j, 1), b + 1)] or [(None, 0)]))
+        best.append(row)
+
+    centers = []
+    for j in range(count):
+        medians = []
+        b = size - 1
+        for i in range(j, -1, -1):
+            a = best[i][b][1]
+            medians.append(values[median(a, b)])
+            b = a - 1
+        centers.append(sorted(medians))
+    return centers
+
+def print_str_path(characters, bases):
+    '''
+    Chooses the cell to print each character from, given the initial cell
+    values, with a Viterbi style dynamic programming: for every character
+    and cell it keeps the cheapest way to print up to that character ending
+    on that cell, counting the pointer moves and the changes of value, and
+    the cell values that way leaves. Returns the cost and the list of cells.
+    '''
+    cells = range(len(bases))
+    costs = [abs(c) for c in cells]     # The cursor starts on cell 0
+    values = [list(bases) for c in cells]
+    back = []
+    for character in characters:
+        new_costs = []
+        new_values = []
+        pointers = []
+        for c in cells:
+            cost, p = min([(costs[p] + abs(c - p) + abs(character - values[p][c]), p) for p in cells])
+            new_costs.append(cost + 1)
+            v = list(values[p])
+            v[c] = character
+            new_values.append(v)
+            pointers.append(p)
+        back.append(pointers)
+        costs = new_costs
+        values = new_values
+    cost, c = min([(costs[c], c) for c in cells])
+    path = []
+    for pointers in reversed(back):
+        path.append(c)
+        c = pointers[c]
+    path.reverse()
+    return cost, path
+
+def print_str_and_clean_planned(characters, cluster_size, multipliers, path):
+    '''
+    Builds the PRINT_STR_AND_CLEAN code for the given cells (cluster_size
+    times each multiplier) and the cell to print each character from.
+    '''
+    buffer = []
+    values = [m * cluster_size for m in multipliers]
+
+    # Sanity gap and initial data
+    buffer.append(">")
+    buffer.append("+" * cluster_size)
+    buffer.append("[")
+    for m in multipliers:
+        buffer.append(">")
+        buffer.append("+" * m)
+    buffer.append("<" * len(multipliers))
+    buffer.append("-]>")
+
+    cursor = 0
+    for character, cell in zip(characters, path):
+        buffer.append(flow_move(cell - cursor) or '')
+        cursor = cell
+        d = character - values[cell]
+        buffer.append("+" * d if d > 0 else "-" * -d)
+        values[cell] = character
+        buffer.append(".")
+
+    # Clean. CLEAN stops at the first zero cell, so if any cell ended at
+    # zero clear them one by one instead.
+    buffer.append(">" * (len(values) - cursor))
+    if 0 in values:
+        buffer.append("<[-]" * len(values))
+        buffer.append("<<")
+    else:
+        buffer.append(operators['CLEAN']['code'])
+        buffer.append("<")
+    return ''.join(buffer)
+
+def print_str_and_clean_optimal(s, max_cells = 8, candidates = 3, objective = 'size'):
+    '''
+    Chooses the cell values from the best grouping of the characters for
+    every number of cells up to max_cells and every cluster size from 4 to
+    24, estimates the cost of each, and plans the printing path of the best
+    candidates to return the best code for the objective.
+    '''
+    characters = [ord(c) for c in s]
+    if not characters:
+        return ''
+
+    estimates = []
+    for medians in str_centers(characters, max_cells):
+        for cluster_size in range(4, 25):
+            multipliers = sorted(set([int(round(float(m) / cluster_size)) for m in medians]))
+            bases = [m * cluster_size for m in multipliers]
+            estimate = cluster_size + sum(multipliers) + 2 * len(multipliers) + 6
+            for character in characters:
+                estimate += min([abs(character - b) for b in bases])
+            estimates.append((estimate, cluster_size, multipliers))
+    estimates.sort()
+
+    variants = []
+    for estimate, cluster_size, multipliers in estimates[:candidates]:
+        cost, path = print_str_path(characters, [m * cluster_size for m in multipliers])
+        variants.append(print_str_and_clean_planned(characters, cluster_size, multipliers, path))
+    return choose_variant(variants, objective)
+
+def print_str_and_clean(s, objective = 'size'):
+    '''
+    Calculates the best BF code for the objective to print a string using
+    the cells to the right of the cursor, and clean them afterwards
+    '''
+    variants = [print_str_and_clean_cluster(s, 16), print_str_and_clean_cluster(s, 8)]
+    variants.append(print_str_and_clean_optimal(s, objective = objective))
+    return choose_variant(variants, objective)
+operators['PRINT_STR_AND_CLEAN'] = { "callable": print_str_and_clean, "parameters": 1, "objective": True }
 
 # -----------------------------------------------------------------------------
 # LOAD_STR
@@ -305,8 +692,14 @@ def load_str_cluster(s, cluster_size = 16):
     # Decode the request string
     characters = [ord(c) for c in s]
 
-    # Get the closest cluster start for each character
-    multipliers = [int(round(c/cluster_size,0)) for c in characters]
+    # Get the cheapest cluster start for each character, counting both the
+    # '+' in the loop and the ones after it
+    multipliers = []
+    for c in characters:
+        m = c / cluster_size
+        if m + 1 + (m + 1) * cluster_size - c < m + c - m * cluster_size:
+            m += 1
+        multipliers.append(m)
 
     # Load initial data
     buffer.append("+" * cluster_size)
@@ -329,23 +722,31 @@ def load_str_cluster(s, cluster_size = 16):
     # Return result
     return ''.join(buffer)
 
-def load_str(s):
+def load_str(s, objective = 'size'):
     '''
-    Calculates the shortest BF code to load a given string
+    Calculates the best BF code for the objective to load a given string
     '''
-    
-    # Start values
-    code = None
-    min = 1000
-
-    for size in range (8,16,2):
-        tmp = load_str_cluster(s, size)
-        if len(tmp) < min:
-            code = tmp
-            min = len(tmp)
-
-    return code
-operators['LOAD_STR'] = { "callable": load_str, "parameters": 1 }
+    characters = [ord(c) for c in s]
+    lineal = ''.join([">" + "+" * c for c in characters]) + ">"
+    if objective != 'size':
+        variants = [load_str_cluster(s, size) for size in range(2, 33)]
+        return choose_variant(variants + [lineal], objective)
+
+    # Each cell costs its multiplier in the loop plus the distance to its
+    # character afterwards, so for a given cluster size the best multiplier
+    # of every character is independent and the total cost is known
+    # without building the code.
+    best = None
+    for size in range(2, 33):
+        cost = size
+        for c in characters:
+            m = c / size
+            cost += min(m + c - m * size, m + 1 + (m + 1) * size - c)
+        if best is None or cost < best[0]:
+            best = (cost, size)
+
+    return choose_variant([load_str_cluster(s, best[1]), lineal], objective)
+operators['LOAD_STR'] = { "callable": load_str, "parameters": 1, "objective": True }
 
 # -----------------------------------------------------------------------------
 # PRINT FUNTIONS
@@ -363,6 +764,188 @@ operators['PRINT_NUM'] = { "code": "<[>+<-]>[>+++++++++[+<[->-[>+>>]>[+[-<+>]>+>
 operators['READ_CHR'] = { "code": ",>" }
 operators['READ_NUM'] = { "code": ">>>+[-<,----------[<<[>++++++++++<-]>>>++++++[<------>-]<--[<+>-]<[<+>-]>>+<]>]<<" }
 
+# =============================================================================
+# OPTIMIZER
+# =============================================================================
+
+def optimize_tokenize(code):
+    '''
+    Splits BF code into tokens: ('+', n) and ('>', n) for the net result of
+    a run of increments or moves (n can be negative) and (c, 1) for any other
+    operator. Zero runs and debug ('#') operators are dropped.
+    '''
+    tokens = []
+    for c in code:
+        if c in '+-':
+            kind, n = '+', (1 if c == '+' else -1)
+        elif c in '><':
+            kind, n = '>', (1 if c == '>' else -1)
+        elif c in '[].,':
+            tokens.append((c, 1))
+            continue
+        else:
+            continue
+        if len(tokens) and tokens[-1][0] == kind:
+            n += tokens.pop()[1]
+        if n:
+            tokens.append((kind, n))
+    return tokens
+
+def optimize_untokenize(tokens):
+    buffer = []
+    for kind, n in tokens:
+        if kind == '+':
+            buffer.append('+' * n if n > 0 else '-' * -n)
+        elif kind == '>':
+            buffer.append('>' * n if n > 0 else '<' * -n)
+        else:
+            buffer.append(kind)
+    return ''.join(buffer)
+
+def optimize_pass(tokens):
+    '''
+    One pass over the tokens tracking which cells have a known value,
+    relative to the position of the cursor. At the start every cell is zero,
+    after a loop only the current cell is known (zero). Removes:
+        - loops entered on a cell known to be zero (like a [-] after a clear)
+        - increments immediately overwritten by a clear loop ([-] or [+])
+    and merges the runs left next to each other by the removals.
+    '''
+    output = []
+    known = {}              # Cell values by position, None if unknown
+    zero = True             # Whether cells not in known are zero
+    pos = 0                 # Cursor position
+    i = 0
+    while i < len(tokens):
+        kind, n = tokens[i]
+
+        if kind == '[':
+            if known.get(pos, 0 if zero else None) == 0:
+                # Dead loop: skip to the matching bracket, if there is one
+                depth = 0
+                end = i
+                while end < len(tokens):
+                    if tokens[end][0] == '[':
+                        depth += 1
+                    elif tokens[end][0] == ']':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    end += 1
+                if end < len(tokens):
+                    i = end + 1
+                    continue
+            if i + 2 < len(tokens) and tokens[i+1][0] == '+' and tokens[i+1][1] in (1, -1) \
+                    and tokens[i+2][0] == ']':
+                # Clear loop: increments right before it are useless
+                if len(output) and output[-1][0] == '+':
+                    output.pop()
+            known = {}
+            zero = False
+            pos = 0
+
+        elif kind == ']':
+            known = {0: 0}
+            zero = False
+            pos = 0
+
+        elif kind == '+':
+            value = known.get(pos, 0 if zero else None)
+            known[pos] = None if value is None else value + n
+
+        elif kind == '>':
+            pos += n
+
+        elif kind == ',':
+            known[pos] = None
+
+        # Merge with the previous token if removals left two of a kind
+        if kind in '+>' and len(output) and output[-1][0] == kind:
+            n += output.pop()[1]
+            if n == 0:
+                i += 1
+                continue
+        output.append((kind, n))
+        i += 1
+
+    return output
+
+def optimize_tokens(tokens):
+    '''
+    Runs optimize_pass() on the tokens until nothing changes.
+    '''
+    while True:
+        optimized = optimize_pass(tokens)
+        if optimized == tokens:
+            return tokens
+        tokens = optimized
+
+def optimize(code):
+    '''
+    Peephole optimizer for generated code. Nets out every run of moves and
+    increments and removes dead code, repeating until nothing changes.
+    '''
+    return optimize_untokenize(optimize_tokens(optimize_tokenize(code)))
+
+def optimize_chunk(chunk):
+    '''
+    Returns the tokens of a chunk of code for optimize_stream(), with the
+    change of loop depth over the chunk and the lowest one reached.
+    '''
+    tokens = optimize_tokenize(chunk)
+    depth = low = 0
+    for kind, n in tokens:
+        if kind == '[':
+            depth += 1
+        elif kind == ']':
+            depth -= 1
+            low = min(low, depth)
+    return tokens, depth, low
+
+def optimize_stream(chunks):
+    '''
+    Generator running the optimizer on code coming in chunks and yielding
+    the optimized code as soon as it is final. Nothing the optimizer does
+    crosses the end of a top level loop (only the current cell is known
+    there, to be zero), so the tokens are optimized and written out every
+    time a chunk ends with one that survives. Only the code since the last
+    one is kept in memory.
+    '''
+    scanned = {}            # optimize_chunk() results, by chunk
+    tokens = []
+    depth = 0
+    start = 0               # 1 when tokens starts with the ']' already written
+    for chunk in chunks:
+        try:
+            new, change, low = scanned[chunk]
+        except KeyError:
+            if len(scanned) >= 4096:
+                scanned.clear()
+            new, change, low = scanned[chunk] = optimize_chunk(chunk)
+        if not new:
+            continue
+
+        # Merge the runs at the joint, as optimize_tokenize() would
+        i = 0
+        while i < len(new) and len(tokens) > start and new[i][0] in '+>' and tokens[-1][0] == new[i][0]:
+            kind, n = new[i]
+            n += tokens.pop()[1]
+            i += 1
+            if n:
+                tokens.append((kind, n))
+                break
+        tokens.extend(new[i:])
+
+        # Unmatched ']' count as top level ones
+        depth += change - min(0, depth + low)
+        if depth == 0 and new[-1][0] == ']':
+            tokens = optimize_tokens(tokens)
+            if len(tokens) > start and tokens[-1][0] == ']':
+                yield optimize_untokenize(tokens[start:])
+                tokens = tokens[-1:]
+                start = 1
+    yield optimize_untokenize(optimize_tokens(tokens)[start:])
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
@@ -374,54 +957,309 @@ APP_VERSION = "0.1"
 # MAIN CODE
 # =============================================================================
 
-def run(code, debug=False, linewrap=40):
-
-    print code
-    cursor = 0
-    buffer = []
-
-    if debug:
-        title = "%s v%s" % (APP_NAME, APP_VERSION)
-        print "=" * len(title)
-        print title
-        print "=" * len(title)
-        print ""
-
-    tokens = shlex.split(argv)
-    while len(tokens):
+@lru_cache(4096)
+def expand_operator(token, parameters, objective = 'size'):
+    '''
+    Returns the code for an operator and its parameters (a tuple). Callable
+    operators are only expanded once for the same parameters, and those
+    with several implementations get the objective to choose among them.
+    '''
+    op = operators[token]
+    if 'code' in op:
+        return op['code']
+    if op.get('objective'):
+        return op['callable'](*parameters, objective = objective)
+    return op['callable'](*parameters)
+
+def tokenize(lines):
+    '''
+    Generator splitting a BFCG source, given as a file or any other iterable
+    of lines, into tokens with shell-like quoting. Lines are split one at a
+    time, joined to the next ones while a quoted string is left open.
+    '''
+    pending = ''
+    for line in lines:
+        pending += line
+        try:
+            tokens = shlex.split(pending)
+        except ValueError:
+            continue
+        pending = ''
+        for token in tokens:
+            yield token
+    if pending:
+        for token in shlex.split(pending):
+            yield token
+
+def parse_tokens(tokens):
+    '''
+    Generator turning tokens (any iterable, read as needed) into (operator,
+    parameters) tuples. Numbers are loaded with LOAD_NUM and any other
+    unknown token is a string, loaded with LOAD_STR unless followed by
+    PRINT_STR_AND_CLEAN.
+    '''
+    tokens = iter(tokens)
+    following = next(tokens, None)
+    while following is not None:
 
-        token = tokens.pop(0)
-        parameters=[]
+        token = following
+        following = next(tokens, None)
+        parameters = ()
 
         if token in operators:
-
-            op = operators[token]
-            if 'code' in op:
-                response = op['code']
-            else:
-                parameters = []
-                for i in range(0, op['parameters']):
-                    parameters.append(tokens.pop(0))
-                response = op['callable'](*parameters)
+            parameters = []
+            for i in range(operators[token].get('parameters', 0)):
+                if following is None:
+                    break
+                parameters.append(following)
+                following = next(tokens, None)
+            parameters = tuple(parameters)
 
         elif token.isdigit():
-            response = load_num(int(token))        
-            parameters = [token]
+            parameters = (token,)
             token = "LOAD_NUM"
 
         else:
-            if tokens[0] == "PRINT_STR_AND_CLEAN":
-                response = print_str_and_clean(token)
-                parameters = [token]
+            parameters = (token,)
+            if following == "PRINT_STR_AND_CLEAN":
                 token = "PRINT_STR_AND_CLEAN"
             else:
-                response = load_str(token)
-                parameters = [token]
                 token = "LOAD_STR"
-            if len(tokens) and tokens[0] == token:
-                tokens = tokens[1:]
+            if following == token:
+                following = next(tokens, None)
+
+        yield token, parameters
+
+# Values below this limit give the same results for NOT, AND, OR and DIV
+# whatever the cell size of the interpreter running the code
+FOLD_LIMIT = 256
+
+# ADD and MUL are only folded when the result is below this limit, so a
+# short source never turns into a much larger number to load
+FOLD_RESULT_LIMIT = FOLD_LIMIT * FOLD_LIMIT
+
+def fold_value(token, parameters, known):
+    '''
+    Applies an operator to the known values on top of the stack (a list,
+    last item on top). Returns False, leaving the list untouched, if the
+    operator can not be evaluated at compile time.
+    '''
+    count = len(known)
+    small = all([value < FOLD_LIMIT for value in known[-2:]])
+
+    if token == 'LOAD_NUM':
+        known.append(int(parameters[0]))
+    elif token in ('INC', 'INCN') and count >= 1:
+        known[-1] += int((parameters or (1,))[0])
+    elif token in ('DEC', 'DECN') and count >= 1 and known[-1] >= int((parameters or (1,))[0]):
+        known[-1] -= int((parameters or (1,))[0])
+    elif token == 'NOT' and count >= 1 and known[-1] < FOLD_LIMIT:
+        known[-1] = int(known[-1] == 0)
+    elif token == 'DUP' and count >= 1:
+        known.append(known[-1])
+    elif token == 'DROP' and count >= 1:
+        known.pop()
+    elif count < 2:
+        return False
+    elif token == 'ADD' and known[-2] + known[-1] < FOLD_RESULT_LIMIT:
+        known[-2:] = [known[-2] + known[-1]]
+    elif token == 'MUL' and known[-2] * known[-1] < FOLD_RESULT_LIMIT:
+        known[-2:] = [known[-2] * known[-1]]
+    elif token == 'SUB' and known[-2] >= known[-1]:
+        known[-2:] = [known[-2] - known[-1]]
+    elif token == 'DIV' and small and known[-1] > 0:
+        known[-2:] = list(divmod(known[-2], known[-1]))
+    elif token == 'AND' and small:
+        known[-2:] = [int(bool(known[-2] and known[-1]))]
+    elif token == 'OR' and small:
+        known[-2:] = [int(bool(known[-2] or known[-1]))]
+    elif token == 'SWAP':
+        known[-2:] = [known[-1], known[-2]]
+    elif token == 'ROT' and count >= 3:
+        known[-3:] = [known[-2], known[-1], known[-3]]
+    else:
+        return False
+    return True
+
+def fold_constants(operations):
+    '''
+    Generator folding the operators applied to values known at compile time,
+    like '2 3 DUP MUL ADD', into a single LOAD_NUM. Known values are only
+    loaded when an operator can not be evaluated, like READ_NUM or a flow
+    control operator, so the stack layout is the same as without folding.
+    '''
+    known = []
+    for token, parameters in operations:
+        if fold_value(token, parameters, known):
+            continue
+        for value in known:
+            yield "LOAD_NUM", (str(value),)
+        known = []
+        yield token, parameters
+    for value in known:
+        yield "LOAD_NUM", (str(value),)
+
+# Operators taking the two values on top of the stack in any order
+COMMUTATIVE = ('ADD', 'MUL', 'AND', 'OR')
+
+# Largest stack window kept by plan_layout(), as ARRANGE takes one digit
+# per cell
+PLAN_LIMIT = 8
+
+def plan_arrange(layout):
+    '''
+    Returns the ARRANGE parameter for a layout of plan_layout().
+    '''
+    return ''.join(['x' if value is None else str(value) for value in layout])
+
+def plan_layout(operations):
+    '''
+    Generator moving the values at the top of the stack as late and as
+    little as possible. SWAP, ROT and the DROP following them only change
+    a planned layout: the logical position of the value in each cell of a
+    window at the top of the stack, None for the dropped ones. The values
+    are moved in one ARRANGE when another operator needs them in place, so
+    'SWAP SWAP' or 'ROT ROT ROT' emit nothing, 'ROT ROT' moves each value
+    once and 'ROT DROP' moves two values instead of three and a drop. ADD,
+    MUL, AND and OR ignore a swap of their operands.
+    '''
+    layout = []
+
+    def change(mapping):
+        layout[:] = [mapping.get(value, value) for value in layout]
+        # Values already in place need no moving
+        while layout and layout[0] == 0:
+            layout[:] = [None if value is None else value - 1 for value in layout[1:]]
+
+    for token, parameters in operations:
+
+        if token in ('SWAP', 'ROT') or token == 'DROP' and layout:
+            depth = {'SWAP': 2, 'ROT': 3, 'DROP': 1}[token]
+            values = len(layout) - layout.count(None)
+            if len(layout) + max(depth - values, 0) > PLAN_LIMIT:
+                yield "ARRANGE", (plan_arrange(layout),)
+                layout = []
+                values = 0
+            while values < depth:
+                layout[:] = [0] + [None if value is None else value + 1 for value in layout]
+                values += 1
+            top = values - 1
+            if token == 'SWAP':
+                change({top: top - 1, top - 1: top})
+            elif token == 'ROT':
+                change({top - 2: top, top - 1: top - 2, top: top - 1})
+            else:
+                change({top: None})
+            continue
+
+        if layout and token in COMMUTATIVE:
+            top = len(layout) - layout.count(None) - 1
+            swapped = [{top: top - 1, top - 1: top}.get(value, value) for value in layout]
+            if swapped == range(len(layout)):
+                layout = []
+
+        if layout:
+            yield "ARRANGE", (plan_arrange(layout),)
+            layout = []
+        yield token, parameters
+
+    if layout:
+        yield "ARRANGE", (plan_arrange(layout),)
+
+def expand_tokens(tokens, fold = False, objective = 'size', plan = False):
+    '''
+    Generator expanding tokens (any iterable) into (operator, parameters,
+    code) tuples, folding constant expressions first if fold is True and
+    planning the stack layout if plan is True.
+    '''
+    operations = parse_tokens(tokens)
+    if fold:
+        operations = fold_constants(operations)
+    if plan:
+        operations = plan_layout(operations)
+    for token, parameters in operations:
+        yield token, parameters, expand_operator(token, parameters, objective)
+
+# Default options for compile()
+COMPILE_OPTIONS = {
+    'optimize': True,       # Run the peephole optimizer
+    'fold': True,           # Evaluate constant expressions at compile time
+    'plan': True,           # Move stack values only when needed (see plan_layout())
+    'objective': 'size',    # Choose operator implementations by 'size', 'speed' or 'balanced'
+    'linewrap': None,       # Split the code in lines of this length
+}
+
+def wrap_lines(chunks, width):
+    '''
+    Generator splitting the text coming in chunks into lines of 'width'
+    characters (passing it through if width is None), with no line break
+    after the last one.
+    '''
+    if width is not None and width <= 0:
+        raise ValueError('Line width must be positive')
+    if width is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    column = 0
+    for chunk in chunks:
+        pieces = []
+        i = 0
+        while i < len(chunk):
+            if column == width:
+                pieces.append('\n')
+                column = 0
+            piece = chunk[i:i + width - column]
+            pieces.append(piece)
+            column += len(piece)
+            i += len(piece)
+        yield ''.join(pieces)
+
+def compile_stream(input, output, options = None):
+    '''
+    Compiles a BFCG source read from a file (or any iterable of lines) and
+    writes the BF code to the output file as it is generated, so time and
+    memory grow linearly with the size of the program. options is a
+    dictionary overriding COMPILE_OPTIONS. Returns the length written.
+    '''
+    settings = dict(COMPILE_OPTIONS)
+    settings.update(options or {})
+
+    operations = expand_tokens(tokenize(input), settings['fold'], settings['objective'], settings['plan'])
+    chunks = (response for token, parameters, response in operations)
+    if settings['optimize']:
+        chunks = optimize_stream(chunks)
+
+    length = 0
+    for piece in wrap_lines(chunks, settings['linewrap']):
+        output.write(piece)
+        length += len(piece)
+    return length
+
+def compile(source, options = None):
+    '''
+    Compiles a BFCG source string and returns the BF code. options is a
+    dictionary overriding COMPILE_OPTIONS.
+    '''
+    output = StringIO()
+    compile_stream(source.splitlines(True), output, options)
+    return output.getvalue()
+
+def run(code, debug=False, linewrap=40, objective='size'):
+
+    print code
+    run_stream(code.splitlines(True), debug, linewrap, objective)
 
-        if debug:
+def run_stream(input, debug=False, linewrap=40, objective='size'):
+
+    if debug:
+        title = "%s v%s" % (APP_NAME, APP_VERSION)
+        print "=" * len(title)
+        print title
+        print "=" * len(title)
+        print ""
+
+        for token, parameters, response in expand_tokens(tokenize(input), COMPILE_OPTIONS['fold'], objective, COMPILE_OPTIONS['plan']):
             if len(parameters):
                 print "========= %s(%s) ==========" % ( token , ','.join(parameters))
             else:
@@ -429,19 +1267,10 @@ def run(code, debug=False, linewrap=40):
             print
             print response
             print
-        else:
-            buffer.append(response)
 
-        cursor += (response.count(">") - response.count("<"))
-
-    if not debug:
-        optimizations = [ '<>', '><', '+-', '-+', '#' ]
-        response = ''.join(buffer)
-        for item in optimizations:
-            response = response.replace(item, '')
-        while len(response):
-            print response[:linewrap]
-            response = response[linewrap:]    
+    else:
+        if compile_stream(input, sys.stdout, { 'linewrap': linewrap, 'objective': objective }):
+            print
 
 
 if __name__ == '__main__':
@@ -449,5 +1278,46 @@ if __name__ == '__main__':
     Main entry point
     '''
 
-    run(argv, False, 40)
+    import getopt
+
+    debug = False
+    objective = 'size'
+    source = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hdo:f:", ["help", "debug", "optimize=", "file="])
+    except getopt.GetoptError:
+        print "Wrong parameters."
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print "Usage: bfcg.py [-d] [-o size|speed|balanced] [-f file | source]"
+            sys.exit()
+        elif opt in ('-d', '--debug'):
+            debug = True
+        elif opt in ('-o', '--optimize'):
+            if arg not in OBJECTIVES:
+                print "Optimize mode must be one of: %s" % ', '.join(OBJECTIVES)
+                sys.exit(2)
+            objective = arg
+        elif opt in ('-f', '--file'):
+            if arg != '-' and not os.path.exists(arg):
+                print "File '%s' does not exist" % arg
+                sys.exit(2)
+            source = arg
+
+    if source == '-':
+        run_stream(sys.stdin, debug, 40, objective)
+        sys.exit()
+    if source:
+        f = open(source, 'r')
+        run_stream(f, debug, 40, objective)
+        f.close()
+        sys.exit()
+
+    if len(args):
+        argv = ' '.join(args)
+
+    run(argv, debug, 40, objective)
         
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+"""
+Local server compiling BFCG sources and running Brainfuck programs, so
+callers do not pay for the interpreter startup and parsing on every call.
+
+The server listens on a Unix socket or a localhost TCP port and forks a
+pool of workers that accept the connections. Each worker keeps the parsed
+programs it has run in an LRU cache. Requests and responses are JSON
+objects, one per line, and a connection can send any number of requests:
+
+    {"op": "compile", "source": "2 3 ADD PRINT_NUM", "options": {...}}
+    {"code": "..."}
+
+    {"op": "run", "code": ",[.,]", "input": "abc", "max_op": 100000,
+     "mem_size": 30000, "cell_bits": 8, "eof": 0, "engine": "codegen"}
+    {"output": "abc"}
+
+Errors are returned as {"error": message, "errnr": number}, with the
+BrainfuckError numbers. Input and output are byte strings carried as
+latin-1 text. max_op and mem_size (the tape size, which bounds the memory
+used) can not exceed the limits the server was started with. Cells are 8
+bit unless the request asks for others, and every request is stopped
+with errnr 2 after 'seconds' seconds. The time limit can interrupt a
+worker anywhere, even halfway through updating its caches, so the worker
+answers and then exits, and the server forks a fresh one.
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+
+from bf import Brainfuck, BrainfuckError
+import bfcg
+
+# Parsed programs kept by each worker
+PROGRAM_CACHE = 256
+
+# Longest request line accepted, in bytes
+MAX_REQUEST = 16 * 1024 * 1024
+
+# Server limits, also the default of every request
+LIMITS = {
+    'max_op': 10000000,
+    'mem_size': 1000000,
+    'seconds': 10,
+}
+
+# Limits a request can lower
+REQUEST_LIMITS = ('max_op', 'mem_size')
+
+@bfcg.lru_cache(PROGRAM_CACHE)
+def load_program(code, eof):
+    """
+    Return the parsed program, shared by every request running the same
+    code with the same EOF value.
+    """
+    return Brainfuck(code, '', eof = eof)
+
+def parse_address(address):
+    """
+    Return the socket family and address for 'unix:PATH', 'HOST:PORT' or
+    'PORT' (on localhost).
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    host, sep, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def listen(address, backlog = 128):
+    """
+    Return a listening socket for the address (see parse_address()).
+    """
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+def compile_request(request, limits):
+    """
+    Compile a BFCG source, with bfcg.compile() options.
+    """
+    source = request.get('source')
+    if not isinstance(source, basestring):
+        raise BrainfuckError('Missing source', 3)
+    options = request.get('options') or {}
+    if not isinstance(options, dict):
+        raise BrainfuckError('Invalid options', 3)
+    for key, value in options.items():
+        if key not in bfcg.COMPILE_OPTIONS:
+            raise BrainfuckError('Unknown option %s' % key, 3)
+        if key == 'objective':
+            valid = value in bfcg.OBJECTIVES
+        elif key == 'linewrap':
+            valid = value is None or type(value) in (int, long) and value > 0
+        else:
+            valid = isinstance(value, bool)
+        if not valid:
+            raise BrainfuckError('Invalid value for %s' % key, 3)
+    try:
+        return {'code': bfcg.compile(source.encode('latin-1'), options)}
+    except (KeyError, ValueError, TypeError, IndexError), e:
+        raise BrainfuckError('Compilation failed: %s' % e, 3)
+
+def run_request(request, limits):
+    """
+    Run a program on an input, within the server limits.
+    """
+    code = request.get('code')
+    if not isinstance(code, basestring):
+        raise BrainfuckError('Missing code', 3)
+    kwargs = {}
+    for key in REQUEST_LIMITS:
+        limit = limits[key]
+        value = request.get(key, limit)
+        if not isinstance(value, (int, long)) or not 0 < value <= limit:
+            raise BrainfuckError('%s must be between 1 and %i' % (key, limit), 3)
+        kwargs[key] = value
+    kwargs['cell_bits'] = request.get('cell_bits', 8)
+    kwargs['sparse'] = bool(request.get('sparse'))
+    kwargs['engine'] = request.get('engine', 'interpreter')
+    if kwargs['cell_bits'] not in (None, 8, 16, 32):
+        raise BrainfuckError('cell_bits must be 8, 16, 32 or null', 3)
+    if kwargs['engine'] not in ('interpreter', 'codegen'):
+        raise BrainfuckError("engine must be 'interpreter' or 'codegen'", 3)
+
+    eof = request.get('eof', -1)
+    if eof not in (0, -1, None):
+        raise BrainfuckError('eof must be 0, -1 or null', 3)
+    input = request.get('input', u'')
+    if not isinstance(input, basestring):
+        raise BrainfuckError('Invalid input', 3)
+
+    program = load_program(code.encode('latin-1'), eof)
+    if kwargs['engine'] == 'codegen' and program._function is None:
+        program._function = program._build_function()
+    input = input.encode('latin-1')
+    output = program._with_input(input).run(**kwargs)
+    return {'output': output.decode('latin-1')}
+
+# Request handlers, by op
+HANDLERS = {
+    'compile': compile_request,
+    'run': run_request,
+}
+
+class TimeLimit(BrainfuckError):
+    """
+    Raised by the SIGALRM handler when a request runs out of time.
+    """
+
+def timeout(signum, frame):
+    raise TimeLimit('Time limit exceeded', 2)
+
+def handle(line, limits):
+    """
+    Return the response to a request line, as a line, and whether the
+    request was stopped by the time limit of limits['seconds'] seconds,
+    after which the worker must not serve any other.
+    """
+    expired = False
+    previous = signal.signal(signal.SIGALRM, timeout)
+    signal.alarm(limits['seconds'])
+    try:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            raise BrainfuckError('Invalid JSON', 3)
+        if not isinstance(request, dict) or request.get('op') not in HANDLERS:
+            raise BrainfuckError('Unknown op', 3)
+        response = HANDLERS[request['op']](request, limits)
+    except BrainfuckError, e:
+        response = {'error': e.args[0], 'errnr': e.errnr}
+        expired = isinstance(e, TimeLimit)
+    except MemoryError:
+        response = {'error': 'Out of memory', 'errnr': 5}
+    except UnicodeError:
+        response = {'error': 'Strings must be latin-1', 'errnr': 3}
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+    return json.dumps(response) + '\n', expired
+
+def serve_connection(conn, limits):
+    """
+    Answer the requests of a connection until it is closed. Returns True if
+    a request hit the time limit, when the worker has to be replaced.
+    """
+    reader = conn.makefile('rb')
+    writer = conn.makefile('wb')
+    try:
+        while True:
+            line = reader.readline(MAX_REQUEST)
+            if not line:
+                break
+            if not line.endswith('\n'):
+                writer.write(json.dumps({'error': 'Request too long', 'errnr': 3}) + '\n')
+                break
+            response, expired = handle(line, limits)
+            writer.write(response)
+            writer.flush()
+            if expired:
+                return True
+    finally:
+        reader.close()
+        writer.close()
+    return False
+
+def worker(sock, limits):
+    """
+    Accept and serve connections until a request hits the time limit. Runs
+    in a forked process, replaced by serve() when it returns.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            conn, address = sock.accept()
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        try:
+            if serve_connection(conn, limits):
+                return
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+def serve(address, workers = 4, limits = None):
+    """
+    Listen on the address (see parse_address()) and serve it with a pool of
+    forked workers, replacing any that dies, until interrupted or
+    terminated.
+    """
+    limits = dict(limits or LIMITS)
+    sock = listen(address)
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker(sock, limits)
+            finally:
+                os._exit(1)
+        children.add(pid)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        for i in range(workers):
+            spawn()
+        while True:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            children.discard(pid)
+            spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        sock.close()
+        family, path = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(path):
+            os.unlink(path)
+
+class Client(object):
+    """
+    Connection to a server, sending one request at a time.
+    """
+
+    def __init__(self, address):
+        family, address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.reader = self.sock.makefile('rb')
+        self.writer = self.sock.makefile('wb')
+
+    def request(self, request):
+        """
+        Send a request and return the response. Errors are raised as
+        BrainfuckError.
+        """
+        self.writer.write(json.dumps(request) + '\n')
+        self.writer.flush()
+        line = self.reader.readline()
+        if not line:
+            raise BrainfuckError('Connection closed', 3)
+        response = json.loads(line)
+        if 'error' in response:
+            raise BrainfuckError(response['error'], response['errnr'])
+        return response
+
+    def compile(self, source, options = None):
+        """
+        Return the BF code for a BFCG source (see bfcg.compile()).
+        """
+        return self.request({'op': 'compile', 'source': source.decode('latin-1'),
+            'options': options or {}})['code'].encode('latin-1')
+
+    def run(self, code, input = '', **kwargs):
+        """
+        Run the code and return its output. kwargs are max_op, mem_size,
+        cell_bits, sparse, eof and engine.
+        """
+        request = {'op': 'run', 'code': code.decode('latin-1'), 'input': input.decode('latin-1')}
+        request.update(kwargs)
+        return self.request(request)['output'].encode('latin-1')
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    '''
+    Main entry point
+    '''
+
+    import getopt
+
+    address = None
+    workers = 4
+    limits = dict(LIMITS)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hu:p:w:", ["help", "unix=", "port=", "workers=", "max-op=", "mem-size=", "seconds="])
+    except getopt.GetoptError:
+        print "Wrong parameters."
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print "Usage: bfserve.py (-u PATH | -p PORT) [-w WORKERS] [--max-op N] [--mem-size N] [--seconds N]"
+            sys.exit()
+        elif opt in ('-u', '--unix'):
+            address = 'unix:' + arg
+        elif opt in ('-p', '--port'):
+            address = '127.0.0.1:' + arg
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt == '--max-op':
+            limits['max_op'] = int(arg)
+        elif opt == '--mem-size':
+            limits['mem_size'] = int(arg)
+        elif opt == '--seconds':
+            limits['seconds'] = int(arg)
+
+    if not address:
+        print "No address!"
+        sys.exit(2)
+
+    serve(address, workers, limits)